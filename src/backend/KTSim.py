@@ -1,26 +1,300 @@
-from multiprocessing import cpu_count
-from multiprocessing.pool import ThreadPool
-
+import copy
+import re
+import threading
+from functools import lru_cache
+from itertools import combinations_with_replacement
+from math import factorial
+from multiprocessing import Pool
+from statistics import NormalDist
+
+import metrics
 import numpy as np
 
+# Version of the simulation results, part of the cache keys. Bump it when a change to the engine changes the
+# results of a seeded or exact simulation, so the results of the previous engine are not served anymore
+ENGINE_VERSION = 2
+
+# Number of samples simulated at once when streaming
+CHUNKSIZE = 65536
+# Dice values and dice counts always fit in a byte, damages in two
+DICE_DTYPE = np.uint8
+COUNT_DTYPE = np.uint8
+DAMAGE_DTYPE = np.uint16
+
+# "antithetic" pairs every roll of the dice sampler with its mirror 7 - d, "stratified" draws the attack outcomes
+# of the counts sampler in proportion to their probabilities, and "lowdiscrepancy" draws them from an R-sequence
+VARIANCE_REDUCTIONS = {"counts": (None, "stratified", "lowdiscrepancy"), "dice": (None, "antithetic")}
+
+# "sample" simulates the dice, "exact" computes the damage distribution without rolling any
+MODES = ("sample", "exact")
+
+# Quantities whose confidence interval can be targeted by Simulation.run_until
+TARGETS = ("mean", "kill")
+
+
+def generate_dice(n, dice=4, rng=None, workspace=None, name="rolls", antithetic=False):
+    if rng is None:
+        rng = np.random.default_rng()
+    if workspace is None:
+        rolls = rng.integers(1, 7, (n, dice), dtype=DICE_DTYPE)
+    else:
+        # The dice are drawn as bytes and copied in the workspace, a float scratch buffer would take 8 bytes per dice
+        rolls = workspace.get(name, (n, dice), DICE_DTYPE)
+        rolls[:] = rng.integers(1, 7, (n, dice), dtype=DICE_DTYPE)
+    if antithetic:
+        # The second half mirrors the first, a high roll is paired with a low one
+        half = n // 2
+        np.subtract(7, rolls[:half], out=rolls[half : 2 * half])
+    return rolls
+
+
+class Workspace:
+    """
+    Work buffers of the simulation, kept from one run to the next so a run does not allocate its arrays.
+    The buffers grow to the largest run seen, then are reused as they are.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+
+_workspaces = threading.local()
+
+
+def thread_workspace():
+    """
+    Returns the workspace of the calling thread, so concurrent simulations never share buffers.
+    """
+    if not hasattr(_workspaces, "workspace"):
+        _workspaces.workspace = Workspace()
+    return _workspaces.workspace
+
+
+class DamageHistogram:
+    """
+    Running histogram and moments of the damage, so the samples do not need to be kept in memory.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.n = 0
+        self.total = 0
+        self.total_sq = 0
+
+    def update(self, damages):
+        # The moments are computed from the histogram, so the samples are never widened to int64
+        counts = np.bincount(damages)
+        if len(counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(counts) - len(self.counts)))
+        self.counts[: len(counts)] += counts
+        values = np.arange(len(counts))
+        self.n += len(damages)
+        self.total += int(np.sum(counts * values))
+        self.total_sq += int(np.sum(counts * values**2))
+        return self
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(other.counts) - len(self.counts)))
+        self.counts[: len(other.counts)] += other.counts
+        self.n += other.n
+        self.total += other.total
+        self.total_sq += other.total_sq
+        return self
+
+    @property
+    def pmf(self):
+        return self.counts / self.n
+
+    @property
+    def mean(self):
+        return self.total / self.n
+
+    @property
+    def variance(self):
+        return self.total_sq / self.n - self.mean**2
+
+    def kill(self, wounds):
+        """Probability to inflict at least `wounds` damage."""
+        return self.counts[wounds:].sum() / self.n
+
+    def half_width(self, target="mean", wounds=None, confidence=0.95):
+        """
+        Half-width of the normal confidence interval on the mean damage, or of the Wilson score interval on the
+        kill probability. Unlike the normal interval, the Wilson interval does not collapse to zero width when
+        a rare kill has been seen once or never. It is centred on (p + z²/2n) / (1 + z²/n) rather than on p.
+        """
+        if target not in TARGETS:
+            raise ValueError(f"Unknown target {target!r}, expected one of {TARGETS}")
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        if target == "kill":
+            p = self.kill(wounds)
+            return z / (1 + z**2 / self.n) * np.sqrt(p * (1 - p) / self.n + z**2 / (4 * self.n**2))
+        return z * np.sqrt(self.variance / self.n)
+
+
+class PairedDifference:
+    """
+    Running moments of the per-sample damage difference between two scenarios evaluated on the same dice.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.total_sq = 0
+
+    def update(self, damages, baseline):
+        difference = damages.astype(np.int32) - baseline
+        self.n += len(difference)
+        self.total += int(np.sum(difference, dtype=np.int64))
+        self.total_sq += int(np.sum(np.square(difference, dtype=np.int64)))
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.n
+
+    @property
+    def variance(self):
+        return self.total_sq / self.n - self.mean**2
+
+    @property
+    def stderr(self):
+        return np.sqrt(self.variance / self.n)
+
 
-def generate_dice(n, dice=4):
-    # return np.random.randint(1,7, (n,dice))
-    def populate(seed, vector, ix_start, ix_end):
-        rng = np.random.default_rng(seed)
-        vector[ix_start:ix_end] = rng.integers(1, 7, (ix_end - ix_start, dice), dtype=int)
+def summary(pmf, wounds, percentiles=(5, 25, 50, 75, 95)):
+    """
+    Summary statistics of a damage distribution, small enough to be sent instead of the samples.
+    """
+    pmf = np.asarray(pmf, dtype=float)
+    damage = np.arange(len(pmf))
+    cdf = np.cumsum(pmf)
+    mean = float(np.sum(damage * pmf))
+    return {
+        "pmf": np.round(pmf, 6).tolist(),
+        "cdf": np.round(cdf, 6).tolist(),
+        "mean": mean,
+        "variance": float(np.sum((damage - mean) ** 2 * pmf)),
+        # Smallest damage reached with at least p% probability
+        "percentiles": {p: int(np.searchsorted(cdf, p / 100 - 1e-12)) for p in percentiles},
+        "kill": float(np.sum(pmf[wounds:])),
+    }
+
+
+class Rules:
+    """
+    Rules of a weapon profile, parsed once from its keywords.
+    Rules are immutable and hashable, so they can be used as a cache key.
+    """
+
+    __slots__ = (
+        "attacks",
+        "hit",
+        "dmg",
+        "critdmg",
+        "lethal",
+        "accurate",
+        "piercing",
+        "piercing_crit",
+        "devastating",
+        "rerolls",
+        "severe",
+        "punishing",
+        "rending",
+        "saturate",
+    )
+
+    def __init__(self, attacks, hit, dmg, critdmg, keywords=()):
+        values = dict(
+            attacks=attacks,
+            hit=hit,
+            dmg=dmg,
+            critdmg=critdmg,
+            lethal=6,
+            accurate=0,
+            piercing=0,
+            piercing_crit=0,
+            devastating=0,
+            severe="Severe" in keywords,
+            punishing="Punishing" in keywords,
+            rending="Rending" in keywords or "Rend" in keywords,
+            saturate="Saturate" in keywords,
+        )
+        for keyword in keywords:
+            if match := re.search(r"Lethal\s*(\d)", keyword):
+                values["lethal"] = min(values["lethal"], int(match[1]))
+            if match := re.search(r"Dev\s*(\d+)", keyword):
+                values["devastating"] = int(match[1])
+            if match := re.search(r"PrcCrit\s*(\d)", keyword):
+                values["piercing_crit"] = int(match[1])
+            elif match := re.search(r"Prc\s*(\d)", keyword):
+                values["piercing"] = int(match[1])
+            if match := re.search(r"Acc\s*(\d)", keyword):
+                values["accurate"] = int(match[1])
+
+        if "Relentless" in keywords:
+            # All the rolls that need to be rerolled are rerolled, the other rules have nothing left to do
+            values["rerolls"] = ("Relentless",)
+        else:
+            # Start with Cealess before balanced so balanced does not reroll a common value
+            # that could be rerolled with ceaseless
+            values["rerolls"] = ()
+            if "Ceaseless" in keywords:
+                values["rerolls"] += ("Ceaseless",)
+            if any(keyword.startswith("Bal") for keyword in keywords):
+                values["rerolls"] += ("Balanced",)
 
-    array = np.empty((n, dice), dtype=int)
-    n_workers = cpu_count()
-    with ThreadPool(n_workers) as pool:
-        seed_seq = np.random.SeedSequence()
-        seeds = seed_seq.spawn(n_workers)
-        size = int(np.ceil(n / n_workers))
-        args = [[seeds[i], array, i * size, (i + 1) * size] for i in range(n_workers)]
-        if args[-1][3] > n:
-            args[-1][3] = n
-        pool.starmap(populate, args)
-    return array
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Rules are immutable")
+
+    # Pickling restores the slots with setattr, which is forbidden, so the state is restored here instead.
+    # Rules are pickled when a simulation is sent to the processes of Simulation.stream
+    def __getstate__(self):
+        return self.key()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def replace(self, **changes):
+        """
+        Returns a copy of the rules with some values changed.
+        """
+        rules = object.__new__(Rules)
+        for name in self.__slots__:
+            object.__setattr__(rules, name, changes.get(name, getattr(self, name)))
+        return rules
+
+    def key(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Rules) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "Rules(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")"
+
+
+@lru_cache
+def compile_rules(attacks, hit, dmg, critdmg, keywords=frozenset()):
+    """
+    Returns the rules of a weapon profile, shared by every Operator with the same profile.
+    """
+    return Rules(attacks, hit, dmg, critdmg, keywords)
 
 
 class Operator:
@@ -34,321 +308,719 @@ class Operator:
         self.save = row["SV"]
         self.wounds = row["W"]
         self.keywords = set(row["keyword"])
+        self.rules = compile_rules(self.atk, self.hit, self.dmg, self.critdmg, frozenset(self.keywords))
 
-        self.lethal = 6
-        self.piercing = 0
-        self.devastating = 0
-        self.accurate = 0
-
-        for keyword in self.keywords:
-            if "Lethal" in keyword:
-                value = keyword.split(" ")[1][0]
-                self.lethal = np.min([self.lethal, int(value)])
-            if "Dev" in keyword:
-                self.devastating = int(keyword.split("Dev")[1])
-            if "Prc1" in keyword or "Prc2" in keyword:
-                self.piercing = int(keyword.split("Prc")[1])
-            if "Acc" in keyword:
-                self.accurate = int(keyword.split("Acc")[1])
+        self.lethal = self.rules.lethal
+        self.piercing = self.rules.piercing
+        self.devastating = self.rules.devastating
+        self.accurate = self.rules.accurate
 
 
 class Simulation:
-    def __init__(self, offensive_profile, defensive_profile, cover=False, obscured=False):
+    def __init__(self, offensive_profile, defensive_profile, cover=False, obscured=False, sampler="counts", seed=None, variance=None):
         self.attacker = offensive_profile
         self.defender = defensive_profile
         self.cover = cover
         self.obscured = obscured
-        if "Saturate" in self.attacker.keywords:
+        # "counts" draws the number of fails/successes/crits of each attack directly,
+        # "dice" rolls every single dice
+        self.sampler = sampler
+        if variance not in VARIANCE_REDUCTIONS[sampler]:
+            raise ValueError(f"{variance!r} variance reduction is not available with the {sampler!r} sampler")
+        self.variance = variance
+        # Every dice of the simulation is drawn from this generator, so a seeded simulation is reproducible.
+        # Independent streams for parallel runs can be obtained with self.rng.spawn(n)
+        self.rng = np.random.default_rng(seed)
+        self.rules = self.attacker.rules
+        if self.rules.saturate:
             self.cover = False
 
-    def run(self, simstep=1):
-        atk_success, atk_crit, _ = self.attack(simstep)
-        def_success, def_crit, _ = self.defend(simstep, atk_crit)
-        # results = np.vectorize(self.resulting_damage)(atk_success, atk_crit, def_success, def_crit)
-        results = self.resulting_damage(atk_success, atk_crit, def_success, def_crit)
-        return np.array(results)
-
-    def attack(self, simstep=1):
-        atk_rolls = generate_dice(simstep, self.attacker.atk)
-        reroll_mask = np.zeros_like(atk_rolls, dtype=bool)
-
-        success = np.zeros(np.shape(atk_rolls)[0], dtype=int)
-        crit = np.zeros(np.shape(atk_rolls)[0], dtype=int)
-        fail = np.zeros(np.shape(atk_rolls)[0], dtype=int)
-
-        for keyword in self.attacker.keywords:
-            if "Acc" in keyword:
-                success += keyword.split("Acc")[1]
-                atk_rolls = atk_rolls[:, :-1]
-                break
-
-        for keyword in self.attacker.keywords:
-            if keyword == 'Relentless':
-                atk_rolls, reroll_mask = relentless(atk_rolls, self.attacker.hit, reroll_mask)
-                break # All the rolls that needed to be rerolled have been rerolled already
-            if keyword == 'Ceaseless': 
-                # Start with Cealess before balanced so balanced does not reroll a common value 
-                # that could be rerolled with ceaseless
-                atk_rolls, reroll_mask = ceaseless(atk_rolls, self.attacker.hit, reroll_mask)
-            if keyword == 'Bal': 
-                # Balanced can still be usefull after Ceaseless, for example the roll [1,1,2,6], the ones will be rerolled
-                # with ceaseless, but the 2 will be rerolled with balanced
-                atk_rolls, reroll_mask = balanced(atk_rolls, self.attacker.hit, reroll_mask)
-
-
+    def run(self, simstep=1, rng=None, workspace=None):
+        """
+        Simulates `simstep` attacks and returns the damage of each one.
+        With a shared workspace, the returned array is a view of its buffers, overwritten by the next run.
+        """
+        if rng is None:
+            rng = self.rng
+        if workspace is None:
+            workspace = Workspace()
+        metrics.increment("samples", simstep)
+        with metrics.timer("attack"):
+            atk_success, atk_crit, _ = self.draw_attack(simstep, rng, workspace)
+        with metrics.timer("defence"):
+            def_success, def_crit, _ = self.draw_defence(atk_crit, rng, workspace)
+        with metrics.timer("damage"):
+            return self.resulting_damage(atk_success, atk_crit, def_success, def_crit, workspace)
+
+    def draw_attack(self, simstep, rng, workspace, rules=True):
+        if self.sampler == "dice":
+            return self.attack(simstep, rng, workspace, rules)
+        return self.sample_attack(simstep, rng, workspace, rules)
+
+    def draw_defence(self, atk_crit, rng, workspace):
+        if self.sampler == "dice":
+            return self.defend(len(atk_crit), atk_crit, rng, workspace)
+        return self.sample_defence(atk_crit, rng, workspace)
+
+    def stream(self, simstep, chunksize=CHUNKSIZE, rng=None, workers=1):
+        """
+        Runs the simulation by chunks of `chunksize` samples and folds each chunk in a DamageHistogram,
+        so the memory used does not depend on the number of samples.
+        Each chunk draws from its own stream spawned from the generator, so for a given seed the result
+        does not depend on the number of `workers` processes the chunks are shared between.
+        """
+        if rng is None:
+            rng = self.rng
+        sizes = [min(chunksize, simstep - start) for start in range(0, simstep, chunksize)]
+        chunks = [(self, chunk_rng, size) for chunk_rng, size in zip(rng.spawn(len(sizes)), sizes)]
+
+        histogram = DamageHistogram()
+        if workers > 1:
+            with Pool(workers) as pool:
+                for chunk in pool.imap_unordered(simulate_chunk, chunks):
+                    histogram.merge(chunk)
+        else:
+            for chunk in chunks:
+                histogram.merge(simulate_chunk(chunk))
+        return histogram
+
+    def run_until(self, precision, target="mean", confidence=0.95, min_samples=1000, max_samples=10**7, chunksize=CHUNKSIZE, rng=None):
+        """
+        Runs chunks of growing size until the confidence interval on the target, "mean" damage or "kill" probability,
+        is narrower than `precision` on each side, or `max_samples` are drawn.
+        Returns the histogram and the half-width reached.
+        """
+        if target not in TARGETS:
+            raise ValueError(f"Unknown target {target!r}, expected one of {TARGETS}")
+        if precision <= 0:
+            raise ValueError(f"The precision must be positive, got {precision}")
+        if rng is None:
+            rng = self.rng
+        histogram = DamageHistogram()
+        workspace = thread_workspace()
+        size = min(min_samples, max_samples)
+        while True:
+            histogram.update(self.run(size, rng, workspace))
+            error = histogram.half_width(target, self.defender.wounds, confidence)
+            # A chunk with a single damage value has no variance yet, keep sampling until min_samples at least
+            if (error <= precision and histogram.n >= min_samples) or histogram.n >= max_samples:
+                return histogram, float(error)
+            # Double the samples drawn so far, up to `chunksize` samples per chunk: a small run takes a few chunks,
+            # a large one grows by a chunk at a time so its memory stays bounded
+            size = min(histogram.n, chunksize, max_samples - histogram.n)
+
+    def scenario(self, cover=None, obscured=None, save=None, piercing=None):
+        """
+        Returns a copy of the simulation with some of the scenario changed: cover, obscured, the defender save
+        or the weapon piercing. The copy shares the generator of the simulation.
+        """
+        simulation = copy.copy(self)
+        if cover is not None:
+            simulation.cover = cover and not self.rules.saturate
+        if obscured is not None:
+            simulation.obscured = obscured
+        if save is not None:
+            simulation.defender = copy.copy(self.defender)
+            simulation.defender.save = save
+        if piercing is not None:
+            simulation.rules = self.rules.replace(piercing=piercing)
+        return simulation
+
+    def sweep(self, scenarios, simstep, chunksize=CHUNKSIZE, rng=None):
+        """
+        Evaluates every scenario, given as keyword arguments of `scenario`, on the same attack and defence dice.
+        Returns the damage histogram of each scenario and its paired difference with the first scenario.
+        As the scenarios share their dice, the noise of a difference is much smaller than with independent runs.
+        """
+        if rng is None:
+            rng = self.rng
+        simulations = [self.scenario(**scenario) for scenario in scenarios]
+        histograms = [DamageHistogram() for _ in simulations]
+        differences = [PairedDifference() for _ in simulations]
+        workspace = thread_workspace()
+
+        for start in range(0, simstep, chunksize):
+            size = min(chunksize, simstep - start)
+            # The attack is drawn before the rules that depend on the scenario, and the defence dice are all rolled
+            # so a different save or piercing only changes which of them are counted
+            atk_counts = np.stack(self.draw_attack(size, rng, workspace, rules=False))
+            def_rolls = generate_dice(size, 3, rng, workspace, name="defence_rolls")
+
+            baseline = None
+            for simulation, histogram, difference in zip(simulations, histograms, differences):
+                counts = workspace.get("scenario_attack", atk_counts.shape, COUNT_DTYPE)
+                np.copyto(counts, atk_counts)
+                atk_success, atk_crit, _ = simulation.attack_rules(*counts, workspace)
+                def_success, def_crit, _ = simulation.count_defence(def_rolls, atk_crit, workspace)
+                damages = simulation.resulting_damage(atk_success, atk_crit, def_success, def_crit, workspace)
+                if baseline is None:
+                    baseline = damages.copy()
+                histogram.update(damages)
+                difference.update(damages, baseline)
+        return histograms, differences
+
+    def exact(self):
+        """
+        Computes the exact probability mass function of the damage, without rolling any dice.
+        The returned array is indexed by damage value.
+        """
+        dice = self.rules.attacks - self.rules.accurate
+        threshold = min(self.rules.hit, self.rules.lethal)
+        success, crit, fail, prob = attack_distribution(dice, threshold, self.rules.lethal, self.rules.rerolls)
+        success, crit, fail = self.attack_rules(success + self.rules.accurate, crit.copy(), fail.copy())
+
+        dice_to_roll, cover_saves = self.defence_dice(crit)
+
+        atk_success, atk_crit, def_success, def_crit, weights = [], [], [], [], []
+        for n in np.unique(dice_to_roll):
+            rows = np.where(dice_to_roll == n)[0]
+            d_success, d_crit, _, d_prob = defence_distribution(int(n), self.defender.save)
+            atk_success.append(np.repeat(success[rows], len(d_prob)))
+            atk_crit.append(np.repeat(crit[rows], len(d_prob)))
+            def_success.append(np.tile(d_success, len(rows)) + np.repeat(cover_saves[rows], len(d_prob)))
+            def_crit.append(np.tile(d_crit, len(rows)))
+            weights.append(np.outer(prob[rows], d_prob).ravel())
+
+        damages = self.resulting_damage(
+            np.concatenate(atk_success), np.concatenate(atk_crit), np.concatenate(def_success), np.concatenate(def_crit)
+        )
+        return np.bincount(damages, weights=np.concatenate(weights))
+
+    def sample_attack(self, simstep=1, rng=None, workspace=None, rules=True):
+        """
+        Draws the success, crit and fail counts of each attack without rolling the individual dice.
+        With rules=False, the counts are returned before the rules that apply once the dice are rolled.
+        """
+        if rng is None:
+            rng = self.rng
+        if workspace is None:
+            workspace = Workspace()
+        dice = self.rules.attacks - self.rules.accurate
+        threshold = min(self.rules.hit, self.rules.lethal)
+        rerolls = self.rules.rerolls
+        counts = workspace.get("attack", (3, simstep), COUNT_DTYPE)
+
+        if self.variance is None and rerolls in ((), ("Relentless",)):
+            # The dice are independent, the counts follow a multinomial distribution
+            probabilities = die_outcomes(threshold, self.rules.lethal, "Relentless" in rerolls)
+            np.copyto(counts, rng.multinomial(dice, probabilities, size=simstep).T, casting="unsafe")
+        else:
+            # Ceaseless and Balanced depend on the whole roll, draw from the distribution of the outcomes instead
+            outcomes_success, outcomes_crit, outcomes_fail, prob = attack_distribution(
+                dice, threshold, self.rules.lethal, rerolls
+            )
+            if self.variance == "stratified":
+                outcomes = stratified_indices(prob, simstep, rng)
+            elif self.variance == "lowdiscrepancy":
+                # The second coordinate of the sequence is kept for the defence of the same attacks
+                sequence = workspace.get("sequence", (simstep, 2), np.float64)
+                sequence[:] = r_sequence(simstep, 2, rng)
+                outcomes = inverse_cdf(prob, sequence[:, 0])
+            else:
+                outcomes = rng.choice(len(prob), size=simstep, p=prob)
+            for i, outcome in enumerate((outcomes_fail, outcomes_success, outcomes_crit)):
+                np.take(outcome, outcomes, out=counts[i])
+
+        fail, success, crit = counts
+        success += self.rules.accurate
+        if not rules:
+            return success, crit, fail
+        return self.attack_rules(success, crit, fail, workspace)
+
+    def sample_defence(self, atk_crit, rng=None, workspace=None):
+        """
+        Draws the success, crit and fail counts of each defence without rolling the individual dice.
+        """
+        if rng is None:
+            rng = self.rng
+        if workspace is None:
+            workspace = Workspace()
+        dice_to_roll, cover_saves = self.defence_dice(atk_crit, workspace)
+        counts = workspace.get("defence", (3, len(dice_to_roll)), COUNT_DTYPE)
+        if self.variance == "lowdiscrepancy":
+            sequence = workspace.get("sequence", (len(dice_to_roll), 2), np.float64)
+            for n in range(4):
+                rows = dice_to_roll == n
+                outcomes = defence_distribution(n, self.defender.save)
+                index = inverse_cdf(outcomes[3], sequence[rows, 1])
+                for i, outcome in enumerate((outcomes[2], outcomes[0], outcomes[1])):
+                    counts[i, rows] = outcome[index]
+        else:
+            np.copyto(counts, rng.multinomial(dice_to_roll, defence_die_outcomes(self.defender.save)).T, casting="unsafe")
+
+        fail, success, crit = counts
+        # The pierced dice count as fails
+        fail += 3
+        fail -= dice_to_roll
+        fail -= cover_saves
+        success += cover_saves
+        return success, crit, fail
 
+    def attack(self, simstep=1, rng=None, workspace=None, rules=True):
+        if rng is None:
+            rng = self.rng
+        if workspace is None:
+            workspace = Workspace()
+        with metrics.timer("generate_dice"):
+            atk_rolls = generate_dice(simstep, self.rules.attacks, rng, workspace, antithetic=self.variance == "antithetic")
+        reroll_mask = workspace.get("reroll_mask", atk_rolls.shape, bool)
+        reroll_mask.fill(False)
+        threshold = min(self.rules.hit, self.rules.lethal)
+
+        counts = workspace.get("attack", (3, simstep), COUNT_DTYPE)
+        counts.fill(0)
+        fail, success, crit = counts
+
+        if self.rules.accurate:
+            success += self.rules.accurate
+            atk_rolls = atk_rolls[:, self.rules.accurate:]
+            reroll_mask = reroll_mask[:, self.rules.accurate:]
+
+        for rule in self.rules.rerolls:
+            with metrics.timer(rule.lower()):
+                if rule == "Relentless":
+                    atk_rolls, reroll_mask = relentless(atk_rolls, threshold, reroll_mask, rng)
+                if rule == "Ceaseless":
+                    atk_rolls, reroll_mask = ceaseless(atk_rolls, threshold, reroll_mask, rng)
+                if rule == "Balanced":
+                    # Balanced can still be usefull after Ceaseless, for example the roll [1,1,2,6], the ones will be rerolled
+                    # with ceaseless, but the 2 will be rerolled with balanced
+                    atk_rolls, reroll_mask = balanced(atk_rolls, threshold, reroll_mask, rng)
+
+        mask = workspace.get("mask", atk_rolls.shape, bool)
         # Check for lethal
-        crit += np.sum(atk_rolls >= self.attacker.lethal, axis=1)
-
-        success += np.sum((atk_rolls >= self.attacker.hit) & (atk_rolls < self.attacker.lethal), axis=1)
-        fail += self.attacker.atk - success - crit
+        np.greater_equal(atk_rolls, self.rules.lethal, out=mask)
+        np.sum(mask, axis=1, dtype=COUNT_DTYPE, out=crit)
+
+        # Every hit that is not a crit is a success, fail is used as a scratch buffer for the hits
+        np.greater_equal(atk_rolls, threshold, out=mask)
+        np.sum(mask, axis=1, dtype=COUNT_DTYPE, out=fail)
+        success += fail
+        success -= crit
+        np.subtract(self.rules.attacks, success, out=fail)
+        fail -= crit
+
+        if not rules:
+            return success, crit, fail
+        return self.attack_rules(success, crit, fail, workspace)
+
+    def attack_rules(self, success, crit, fail, workspace=None):
+        """
+        Applies the rules that change the attack results once the dice are rolled (Severe, Punishing, Rending, Obscured).
+        The conditions are computed before updating the counts, so each rule changes at most one dice per row.
+        The counts are updated in place.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        condition = workspace.get("condition", np.shape(success), bool)
 
         # Check for Severe:
-        if "Severe" in self.attacker.keywords:
-            success[np.where(np.logical_and((crit == 0), (success >= 1)))] -= 1
-            crit[np.where(np.logical_and((crit == 0), (success >= 1)))] += 1
+        if self.rules.severe:
+            np.equal(crit, 0, out=condition)
+            np.logical_and(condition, success, out=condition)
+            success -= condition
+            crit += condition
 
         # Check crit-based keyword
-        if "Punishing" in self.attacker.keywords:
-            fail[np.where(np.logical_and((crit > 0), (fail > 0)))] -= 1
-            success[np.where(np.logical_and((crit > 0), (fail > 0)))] += 1
-        if "Rending" in self.attacker.keywords:
-            success[np.where(np.logical_and((crit > 0), (success > 0)))] -= 1
-            crit[np.where(np.logical_and((crit > 0), (success > 0)))] += 1
+        if self.rules.punishing:
+            np.logical_and(crit, fail, out=condition)
+            fail -= condition
+            success += condition
+        if self.rules.rending:
+            np.logical_and(crit, success, out=condition)
+            success -= condition
+            crit += condition
 
         if self.obscured:
             success += crit
-            crit = np.zeros(np.shape(crit))
-            fail[np.where(success > 0)] += 1
-            success[np.where(success > 0)] -= 1
+            crit.fill(0)
+            np.greater(success, 0, out=condition)
+            fail += condition
+            success -= condition
 
-        for roll, s, c, f in zip(atk_rolls, success, crit, fail):
-            print(f"{roll} - success: {s}, crit: {c}, fail: {f}")
         return success, crit, fail
 
-    def defend(self, simstep, atk_crit):
-        success_def = np.zeros(simstep, dtype=int)
-        crit_def = np.zeros(simstep, dtype=int)
-        fail_def = np.zeros(simstep, dtype=int)
-
-        dice_to_roll = np.zeros(simstep) + 3
-
-        if "PrcCrit" in self.attacker.keywords:
-            dice_to_roll[np.where(atk_crit > 0)] -= np.max(
-                [self.attacker.piercing, int(self.attacker.keyword.split("PrcCrit")[1])]
-            )
-            dice_to_roll[np.where(atk_crit == 0)] -= self.attacker.piercing
-        else:
-            dice_to_roll -= self.attacker.piercing
+    def defence_dice(self, atk_crit, workspace=None):
+        """
+        Returns the number of defence dice to roll and the number of saves retained from cover, for each attack.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        # Signed, so piercing more dice than rolled does not wrap around
+        dice_to_roll = workspace.get("dice_to_roll", np.shape(atk_crit), np.int8)
+        cover_saves = workspace.get("cover_saves", np.shape(atk_crit), np.int8)
+        dice_to_roll.fill(3)
+        cover_saves.fill(0)
+
+        dice_to_roll -= self.rules.piercing
+        # PrcCrit only pierces when a crit is retained
+        extra_piercing = max(self.rules.piercing, self.rules.piercing_crit) - self.rules.piercing
+        if extra_piercing:
+            condition = workspace.get("condition", np.shape(atk_crit), bool)
+            np.greater(atk_crit, 0, out=condition)
+            # cover_saves is used as a scratch buffer before the cover is applied
+            np.multiply(condition, extra_piercing, out=cover_saves)
+            dice_to_roll -= cover_saves
+            cover_saves.fill(0)
+        np.maximum(dice_to_roll, 0, out=dice_to_roll)
 
         if self.cover:
-            success_def[np.where(dice_to_roll > 0)] += 1
-            dice_to_roll[np.where(dice_to_roll > 0)] -= 1
-
-        vals, counts = np.unique(dice_to_roll, return_counts=True)
-
-        defend_rolls = None
-        for val, count in zip(vals.astype(int), counts.astype(int)):
-            if count == 0:
-                pass
-            if defend_rolls is None:
-                defend_rolls = generate_dice(count, val)
-
-            else:
-                defend_rolls = np.concatenate((defend_rolls, generate_dice(val, count)), axis=1, dtype=int)
-
-            crit_def = np.sum(defend_rolls == 6, axis=1)
-            success_def += np.sum((defend_rolls >= self.defender.save) & (defend_rolls < 6), axis=1)
-            fail_def = 3 - success_def - crit_def
-
-            return success_def, crit_def, fail_def
-
-    def resulting_damage(self, atk_success, atk_crit, def_success, def_crit):
-        if True:
-            init = [[a, ac, d, dc] for a, ac, d, dc in zip(atk_success, atk_crit, def_success, def_crit)]
-
-        damages = atk_crit * self.attacker.devastating
-        MW = atk_crit * self.attacker.devastating
-        # TODO: Rework this logic. It is not working properly. The conditions should be initialized before substracting the values, otherwise the evolve through the code.
-        while np.sum(def_crit) > 0:
-            def_crit_non_zero = def_crit > 0
-            atk_crit_non_zero = atk_crit > 0
-            atk_success_non_zero = atk_success > 0
-            # LOGIC:
-            # If there is no atk_crit, then remove a success
-            log1 = def_crit_non_zero & (atk_crit == 0) & (atk_success_non_zero)
-            # If there is an atk_crit and atk_success, and the dmg is more than the crit dmg, remove a success
-            log2 = (
-                def_crit_non_zero
-                & (atk_crit_non_zero)
-                & (atk_success_non_zero)
-                & (self.attacker.dmg > self.attacker.critdmg)
-            )
-
-            atk_success[np.where(log1 | log2)] -= 1
-
-            # If there is no atk, then remove a atk_crit
-            log3 = def_crit_non_zero & (atk_crit_non_zero) & (atk_success == 0)
-            # If there is an atk_crit and atk_success, and the dmg crit is more than the dmg, remove a crit
-            log4 = (
-                def_crit_non_zero
-                & (atk_crit_non_zero)
-                & (atk_success_non_zero)
-                & (self.attacker.dmg <= self.attacker.critdmg)
-            )
-
-            atk_crit[np.where(log3 | log4)] -= 1
-
-            # atk_crit[np.where((def_crit > 0) & (atk_crit > 0) & (atk_success > 0) & (self.attacker.dmg <= self.attacker.critdmg))] -= 1
-            # atk_crit[np.where((def_crit > 0) & (atk_crit > 0) & (atk_success == 0))] -= 1
-
-            # atk_success[np.where((def_crit > 0) & (atk_crit > 0) &(atk_success > 0) & (self.attacker.dmg > self.attacker.critdmg))] -= 1
-            # atk_success[np.where((def_crit > 0) & (atk_crit <= 0) & (atk_success > 0))] -= 1
-
-            def_crit[np.where(def_crit > 0)] -= 1
-
-        if np.sum(atk_success) + np.sum(atk_crit) <= 0:
-            return damages
-
-        while np.sum(def_success) > 0:
-            # LOGIC:
-            # If there is at least two def success and an atk crit, and no atk success, remove an extra def success and an atk crit
-            log0 = (def_success >= 2) & (atk_crit > 0) & (atk_success == 0)
-            # If there is at least two def success and an atk crit, and atk success is less than 2 and the dmg is less than the crit dmg,
-            # remove an extra def success and an atk crit
-            log1 = (
-                (def_success >= 2)
-                & (atk_crit > 0)
-                & (atk_success < 2)
-                & (atk_success > 0)
-                & (self.attacker.dmg <= self.attacker.critdmg)
-            )
-            # If there is at least two def success and an atk crit, and at least two atk success and the 2*dmg is less than the crit dmg,
-            # remove an extra def success and an atk crit
-            log2 = (
-                (def_success >= 2)
-                & (atk_crit > 0)
-                & (atk_success >= 2)
-                & (2 * self.attacker.dmg <= self.attacker.critdmg)
-            )
-
-            # If there is less than two success, remove an atk success
-            log3 = (def_success < 2) & (def_success > 0) & (atk_success > 0)
-            # If there is no atk crit, remove an atk success
-            log4 = (atk_crit == 0) & (def_success > 0) & (atk_success > 0)
-            # If there is at least two def success and an atk crit, and at least two atk success and the 2*dmg is more than the crit dmg,
-            # remove two atk success
-            log5 = (
-                (def_success >= 2)
-                & (atk_crit > 0)
-                & (atk_success >= 2)
-                & (2 * self.attacker.dmg > self.attacker.critdmg)
-            )
-
-            # If there is only one def success, remove an atk success
-            log6 = (def_success == 1) & (atk_success > 0)
-
-            atk_crit[np.where(log0 | log1 | log2)] -= 1
-            atk_success[np.where(log3 | log4 | log6)] -= 1
-            atk_success[np.where(log5)] -= 2
-
-            def_success[np.where(log0 | log1 | log2 | log5)] -= 1
-            def_success[np.where(def_success > 0)] -= 1
+            np.greater(dice_to_roll, 0, out=cover_saves)
+            dice_to_roll -= cover_saves
+
+        return dice_to_roll.view(COUNT_DTYPE), cover_saves.view(COUNT_DTYPE)
+
+    def defend(self, simstep, atk_crit, rng=None, workspace=None):
+        """
+        Rolls the three defence dice of every attack at once, then only counts the dice left after piercing and cover.
+        """
+        if rng is None:
+            rng = self.rng
+        if workspace is None:
+            workspace = Workspace()
+        def_rolls = generate_dice(simstep, 3, rng, workspace, "defence_rolls", self.variance == "antithetic")
+        return self.count_defence(def_rolls, atk_crit, workspace)
+
+    def count_defence(self, def_rolls, atk_crit, workspace=None):
+        """
+        Success, crit and fail counts of the defence rolls, given the crits of the attack they answer.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        simstep = len(def_rolls)
+        dice_to_roll, cover_saves = self.defence_dice(atk_crit, workspace)
+
+        # The first dice_to_roll dice of each row are rolled, the others were pierced or replaced by cover
+        active = workspace.get("active", def_rolls.shape, bool)
+        np.less(np.arange(3, dtype=COUNT_DTYPE), dice_to_roll[:, None], out=active)
+        mask = workspace.get("mask", def_rolls.shape, bool)
+
+        counts = workspace.get("defence", (3, simstep), COUNT_DTYPE)
+        fail, success, crit = counts
+
+        np.equal(def_rolls, 6, out=mask)
+        mask &= active
+        np.sum(mask, axis=1, dtype=COUNT_DTYPE, out=crit)
+
+        # Every save that is not a crit is a success, fail is used as a scratch buffer for the saves
+        np.greater_equal(def_rolls, min(self.defender.save, 6), out=mask)
+        mask &= active
+        np.sum(mask, axis=1, dtype=COUNT_DTYPE, out=fail)
+        np.subtract(fail, crit, out=success)
+        success += cover_saves
+
+        np.subtract(3, success, out=fail)
+        fail -= crit
+        return success, crit, fail
 
-            # def_success[np.where((def_success >= 2) & (atk_crit > 0) & (atk_success < 2) & (atk_success > 0) & (self.attacker.dmg <= self.attacker.critdmg))] -= 1
-            # atk_crit[np.where((def_success >= 2) & (atk_crit > 0) & (atk_success < 2) & (atk_success > 0) & (self.attacker.dmg <= self.attacker.critdmg))] -= 1
+    def resulting_damage(self, atk_success, atk_crit, def_success, def_crit, workspace=None):
+        """
+        Damage inflicted by each attack once the defender allocated its saves.
+        The damage only depends on the four counts, so it is read from the allocation table of the weapon.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        table = damage_table(self.rules.attacks, self.rules.dmg, self.rules.critdmg, self.rules.devastating)
+
+        # Flat index of the counts in the table
+        index = workspace.get("index", np.shape(atk_success), np.intp)
+        np.multiply(atk_success, table.shape[1], out=index, dtype=np.intp)
+        index += atk_crit
+        index *= table.shape[2]
+        index += def_success
+        index *= table.shape[3]
+        index += def_crit
+
+        damages = workspace.get("damages", np.shape(atk_success), DAMAGE_DTYPE)
+        return np.take(table, index, out=damages)
+
+
+def matchup_matrix(attackers, defenders, cover=False, obscured=False, simstep=1000, mode="sample", sampler="counts", seed=None, chunksize=CHUNKSIZE):
+    """
+    Damage distributions of every attacker against every defender, as a grid of pmf indexed [attacker][defender].
+    The attack does not depend on the defender, so in sample mode each chunk of attacks is drawn once and
+    shared by all the defenders.
+    """
+    if not defenders:
+        raise ValueError("matchup_matrix needs at least one defender")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+    grid = []
+    rng = np.random.default_rng(seed)
+    workspace = thread_workspace()
+    for attacker, attacker_rng in zip(attackers, rng.spawn(len(attackers))):
+        simulations = [Simulation(attacker, defender, cover, obscured, sampler) for defender in defenders]
+        if mode == "exact":
+            grid.append([simulation.exact() for simulation in simulations])
+            continue
+
+        histograms = [DamageHistogram() for _ in simulations]
+        for start in range(0, simstep, chunksize):
+            size = min(chunksize, simstep - start)
+            atk_success, atk_crit, _ = simulations[0].draw_attack(size, attacker_rng, workspace)
+            for simulation, histogram in zip(simulations, histograms):
+                def_success, def_crit, _ = simulation.draw_defence(atk_crit, attacker_rng, workspace)
+                histogram.update(simulation.resulting_damage(atk_success, atk_crit, def_success, def_crit, workspace))
+        grid.append([histogram.pmf for histogram in histograms])
+    return grid
+
+
+def r_sequence(n, dims, rng):
+    """
+    n points of the R-sequence in [0, 1)^dims, randomly shifted: the additive recurrence on the powers of the
+    generalised golden ratio, which covers the cube more evenly than independent uniforms.
+    """
+    # phi is the root of x**(dims + 1) = x + 1
+    phi = 2.0
+    for _ in range(30):
+        phi = (1 + phi) ** (1 / (dims + 1))
+    alpha = (1 / phi) ** np.arange(1, dims + 1)
+    return (rng.random(dims) + np.arange(1, n + 1)[:, None] * alpha) % 1
 
-            # atk_success[np.where((def_success < 2) & (def_success > 0) & (atk_success > 0))] -= 1
 
-            # def_success[np.where((def_success >= 2) & (atk_crit > 0) & (atk_success >= 2) & (2 * self.attacker.dmg <= self.attacker.critdmg))] -= 1
-            # atk_crit[np.where((def_success >= 2) & (atk_crit > 0) & (atk_success >= 2) & (2 * self.attacker.dmg <= self.attacker.critdmg))] -= 1
-            # atk_success[np.where((def_success >= 2) & (atk_crit > 0) & (atk_success >= 2) & (2 * self.attacker.dmg > self.attacker.critdmg))] -= 1
+def stratified_indices(prob, n, rng):
+    """
+    Draws n outcomes of the distribution `prob`, each outcome appearing floor(n * p) times,
+    and the remaining draws spread according to the fractional parts. The outcomes are returned shuffled.
+    """
+    expected = prob * n
+    counts = np.floor(expected).astype(np.int64)
+    remainder = expected - counts
+    if n > counts.sum():
+        counts += rng.multinomial(n - counts.sum(), remainder / remainder.sum())
+    indices = np.repeat(np.arange(len(prob)), counts)
+    rng.shuffle(indices)
+    return indices
 
-            # def_success[np.where(def_success > 0)] -= 1
 
-        damages += atk_success * self.attacker.dmg + atk_crit * self.attacker.critdmg
+def inverse_cdf(prob, uniform):
+    """Outcomes of the distribution `prob` for the given uniform draws."""
+    return np.minimum(np.searchsorted(np.cumsum(prob), uniform, side="right"), len(prob) - 1)
 
-        if False:
-            for i, d, atk, atk_c, mw in zip(init, damages, atk_success, atk_crit, MW):
-                print(i, d)
-                print(f"{atk}*{self.attacker.dmg} + {atk_c}*{self.attacker.critdmg} + (MW: {mw}) = {d}")
 
-        return damages
+def simulate_chunk(chunk):
+    """
+    Runs one chunk of a streamed simulation. Defined at module level so it can be sent to a process pool.
+    """
+    simulation, rng, simstep = chunk
+    return DamageHistogram().update(simulation.run(simstep, rng, thread_workspace()))
 
 
-def relentless(rolls, threshold=3, reroll_mask=None):
+def relentless(rolls, threshold=3, reroll_mask=None, rng=None):
     """
     Rerolls all dice below a certain threshold, except those that have already been rerolled.
+    The rolls and the reroll mask are updated in place.
     """
+    if rng is None:
+        rng = np.random.default_rng()
     if reroll_mask is None:
         reroll_mask = np.zeros_like(rolls, dtype=bool)
 
     mask = (rolls < threshold) & ~reroll_mask  # Only reroll if not already rerolled
 
-    new_rolls = np.random.randint(1, 7, size=mask.sum())  # Generate necessary values
-    rerolled_rolls = rolls.copy()
-    rerolled_rolls[mask] = new_rolls
+    rolls[mask] = rng.integers(1, 7, size=mask.sum(), dtype=rolls.dtype)  # Rerolled in place
 
-    reroll_mask = reroll_mask | mask  # Update reroll mask
+    reroll_mask |= mask  # Update reroll mask
 
-    return rerolled_rolls, reroll_mask
+    return rolls, reroll_mask
 
 
-def balanced(rolls, threshold=3, reroll_mask=None):
+def balanced(rolls, threshold=3, reroll_mask=None, rng=None):
     """
     Rerolls one random dice per row if at least one dice is below the threshold,
     except for dice that have already been rerolled.
+    The rolls and the reroll mask are updated in place.
     """
+    if rng is None:
+        rng = np.random.default_rng()
     if reroll_mask is None:
         reroll_mask = np.zeros_like(rolls, dtype=bool)
     mask = (rolls < threshold) & ~reroll_mask
     rows_with_low_values = np.any(mask, axis=1)
 
-    col_indices = np.array([
-        np.random.choice(np.where(mask[i])[0]) if rows_with_low_values[i] else -1
-        for i in range(rolls.shape[0])
-    ])
-
-    valid_rows = col_indices != -1
-    new_values = np.random.randint(1, 7, size=valid_rows.sum())
+    # Pick a random low dice in each row: the one with the highest random key
+    keys = rng.random(rolls.shape, dtype=np.float32)
+    keys[~mask] = -1
+    col_indices = np.argmax(keys, axis=1)
 
-    rerolled_rolls = rolls.copy()
-    rerolled_rolls[np.arange(rolls.shape[0])[valid_rows], col_indices[valid_rows]] = new_values
+    rows = np.arange(rolls.shape[0])[rows_with_low_values]
+    cols = col_indices[rows_with_low_values]
+    rolls[rows, cols] = rng.integers(1, 7, size=len(rows), dtype=rolls.dtype)  # Rerolled in place
 
-    reroll_mask[np.arange(rolls.shape[0])[valid_rows], col_indices[valid_rows]] = True  # Update reroll mask
+    reroll_mask[rows, cols] = True  # Update reroll mask
 
-    return rerolled_rolls, reroll_mask
+    return rolls, reroll_mask
 
 
-def ceaseless(rolls, threshold=3, reroll_mask=None):
+def ceaseless(rolls, threshold=3, reroll_mask=None, rng=None):
     """
     Rerolls all occurrences of the most common value in each row that is below the threshold,
     except for dice that have already been rerolled.
+    The rolls and the reroll mask are updated in place.
     """
+    if rng is None:
+        rng = np.random.default_rng()
     if reroll_mask is None:
         reroll_mask = np.zeros_like(rolls, dtype=bool)
 
     mask = (rolls < threshold) & ~reroll_mask
     rows_with_low_values = np.any(mask, axis=1)
 
-    low_values = np.where(mask, rolls, np.nan)
-
-    counts = np.apply_along_axis(
-        lambda row: np.bincount(row[~np.isnan(row)].astype(int), minlength=7),
-        axis=1, arr=low_values
-    )
+    # Number of low dice showing each value, for every row
+    counts = np.stack([np.sum(mask & (rolls == value), axis=1, dtype=COUNT_DTYPE) for value in range(1, 7)], axis=1)
 
-    most_common_values = np.argmax(counts[:, 1:], axis=1) + 1
+    most_common_values = np.argmax(counts, axis=1) + 1
 
     reroll_mask_update = rolls == most_common_values[:, None]
     reroll_mask_update &= rows_with_low_values[:, None]
     reroll_mask_update &= ~reroll_mask  # Ensure we don’t reroll dice that were already changed
 
-    new_values = np.random.randint(1, 7, size=reroll_mask_update.sum())
-
-    rerolled_rolls = rolls.copy()
-    rerolled_rolls[reroll_mask_update] = new_values
+    rolls[reroll_mask_update] = rng.integers(1, 7, size=reroll_mask_update.sum(), dtype=rolls.dtype)  # Rerolled in place
 
     reroll_mask |= reroll_mask_update  # Update reroll mask
 
-    return rerolled_rolls, reroll_mask
\ No newline at end of file
+    return rolls, reroll_mask
+
+
+def compositions(n, parts=3):
+    """
+    Returns all the ways to split n dice into `parts` outcomes, as an array of shape (k, parts).
+    """
+    return np.array([
+        np.bincount(combination, minlength=parts) for combination in combinations_with_replacement(range(parts), n)
+    ]).reshape(-1, parts)
+
+
+def multinomial_pmf(counts, probabilities):
+    """
+    Probability of each row of outcome counts, for dice whose outcomes follow the given probabilities.
+    """
+    counts = np.asarray(counts)
+    n = counts.sum(axis=1)
+    coefficients = np.array([factorial(k) for k in n]) / np.prod(
+        [[factorial(k) for k in row] for row in counts], axis=1
+    ).reshape(-1)
+    return coefficients * np.prod(np.power(probabilities, counts), axis=1)
+
+
+def read_only(*arrays):
+    """
+    Flags the arrays as read-only, since they are shared by the cached functions.
+    """
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays
+
+
+@lru_cache
+def damage_table(attacks, dmg, critdmg, devastating=0):
+    """
+    Damage inflicted for every (success, crit, def_success, def_crit) counts of an attack, with the
+    defender allocating its saves to inflict the least damage:
+    a crit save blocks a success or a crit, a normal save blocks a success, two normal saves block a crit.
+    Devastating damage is inflicted by every crit before the saves are allocated.
+    """
+    metrics.increment("damage_table_builds")
+    success, crit, def_success, def_crit = np.meshgrid(
+        np.arange(attacks + 1), np.arange(attacks + 1), np.arange(4), np.arange(4), indexing="ij"
+    )
+    damages = np.full(success.shape, np.iinfo(DAMAGE_DTYPE).max, dtype=np.int64)
+    # Try every number of crits blocked by crit saves and by pairs of normal saves
+    for crit_blocked in range(4):
+        for pairs in range(2):
+            valid = (crit_blocked <= def_crit) & (2 * pairs <= def_success) & (crit_blocked + pairs <= crit)
+            saves_left = def_crit - crit_blocked + def_success - 2 * pairs
+            damage = (
+                np.maximum(success - saves_left, 0) * dmg
+                + (crit - crit_blocked - pairs) * critdmg
+                + crit * devastating
+            )
+            damages = np.where(valid, np.minimum(damages, damage), damages)
+    return read_only(damages.astype(DAMAGE_DTYPE))[0]
+
+
+@lru_cache
+def die_outcomes(threshold, lethal, relentless=False):
+    """
+    Probabilities of a single attack dice to be a fail, a success or a crit.
+    With Relentless, a fail is rerolled once.
+    """
+    faces = np.arange(1, 7)
+    outcome = np.where(faces >= lethal, 2, np.where(faces >= threshold, 1, 0))
+    probabilities = np.bincount(outcome, minlength=3) / 6
+    if relentless:
+        probabilities = probabilities[0] * probabilities + np.array([0, probabilities[1], probabilities[2]])
+    return read_only(probabilities)[0]
+
+
+@lru_cache
+def defence_die_outcomes(save):
+    """
+    Probabilities of a single defence dice to be a fail, a success or a crit.
+    """
+    faces = np.arange(1, 7)
+    outcome = np.where(faces == 6, 2, np.where(faces >= save, 1, 0))
+    return read_only(np.bincount(outcome, minlength=3) / 6)[0]
+
+
+@lru_cache
+def attack_distribution(dice, threshold, lethal, rerolls=()):
+    """
+    Exact distribution of the attack results of `dice` dice rolled against `threshold`, after rerolls.
+    Returns the success, crit and fail counts of every possible outcome, with their probabilities.
+    """
+    metrics.increment("attack_distribution_builds")
+    faces = np.arange(1, 7)
+    # Outcome of a single die: 0 for a fail, 1 for a success, 2 for a crit
+    outcome = np.where(faces >= lethal, 2, np.where(faces >= threshold, 1, 0))
+    single = die_outcomes(threshold, lethal)
+
+    # Every roll of the dice, as the number of dice showing each face
+    rolls = compositions(dice, 6)
+    prob = multinomial_pmf(rolls, np.full(6, 1 / 6))
+
+    low = rolls[:, faces < threshold]
+    total_low = low.sum(axis=1)
+    rerolled = np.zeros(len(rolls), dtype=int)
+    for rule in rerolls:
+        if rule == "Relentless":
+            rerolled = total_low.copy()
+        if rule == "Ceaseless" and low.shape[1] > 0:
+            # Rerolls all the dice showing the most common low value
+            rerolled += low.max(axis=1)
+        if rule == "Balanced":
+            rerolled += (total_low - rerolled) > 0
+
+    kept = np.stack([rolls[:, outcome == i].sum(axis=1) for i in range(3)], axis=1)
+    kept[:, 0] -= rerolled
+
+    results, weights = [], []
+    for n in np.unique(rerolled):
+        rows = np.where(rerolled == n)[0]
+        new_rolls = compositions(int(n))
+        new_prob = multinomial_pmf(new_rolls, single)
+        results.append((kept[rows, None, :] + new_rolls[None, :, :]).reshape(-1, 3))
+        weights.append(np.outer(prob[rows], new_prob).ravel())
+    results = np.concatenate(results)
+    weights = np.concatenate(weights)
+
+    # Merge identical outcomes
+    outcomes, inverse = np.unique(results, axis=0, return_inverse=True)
+    prob = np.bincount(inverse.ravel(), weights=weights)
+
+    fail, success, crit = outcomes.astype(COUNT_DTYPE).T
+    return read_only(success, crit, fail, prob)
+
+
+@lru_cache
+def defence_distribution(dice, save):
+    """
+    Exact distribution of the defence results of `dice` dice rolled against `save`.
+    Returns the success, crit and fail counts of every possible outcome, with their probabilities.
+    """
+    metrics.increment("defence_distribution_builds")
+    outcomes = compositions(dice)
+    prob = multinomial_pmf(outcomes, defence_die_outcomes(save))
+
+    fail, success, crit = outcomes.astype(COUNT_DTYPE).T
+    return read_only(success, crit, fail, prob)
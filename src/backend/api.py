@@ -1,13 +1,47 @@
-import sqlite3
+import io
+import struct
+from contextlib import asynccontextmanager
 from typing import Optional
 
 import KTSim
+import metrics
+import numpy as np
 import polars as pl
-from fastapi import FastAPI, Query
+from cache import ResultCache, batch_key, matchup_key
+from catalog import CatalogCache
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pool import ConnectionPool
 from pydantic.types import Json
 
-app = FastAPI()
+catalog_pool = None
+catalog_cache = None
+result_cache = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # The catalog connections are opened once for the whole process, and the catalog is loaded in memory.
+    # The result cache is opened here too, so importing the module does not create its database file
+    global catalog_pool, catalog_cache, result_cache
+    catalog_pool = ConnectionPool("killteam2024.db")
+    catalog_cache = CatalogCache("killteam2024.db")
+    result_cache = ResultCache("simulation_cache.db")
+    yield
+    result_cache.close()
+    catalog_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+BINARY_MEDIA_TYPE = "application/octet-stream"
+# "samples" answers with the damage of every sample, "summary" with the statistics of KTSim.summary
+RESPONSES = ("samples", "summary")
+# Per-sample results are cached up to this many samples, a few bytes each once encoded as JSON.
+# Larger ones are sent as they are computed, without building the list of the samples
+MAX_CACHED_SAMPLES = 100000
 
 origins = [
     "http://localhost",
@@ -23,103 +57,201 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    metrics.increment("requests")
+    with metrics.timer("request"):
+        return await call_next(request)
+
+
+def read_database(query, parameters=()):
+    with metrics.timer("read_database"), catalog_pool.connection() as con:
+        return pl.read_database(query=query, connection=con, execute_options={"parameters": parameters})
+
+
 @app.get("/")
 async def help():
     return {"help": "help"}
 
 
+def encode_samples(result):
+    """
+    Encodes the damage samples as a b"KTSD" magic, the 3 characters numpy dtype string and the uint32 number of samples,
+    followed by the samples as uint8, or uint16 if a damage does not fit in a byte.
+    They are decoded with np.frombuffer(content[11:], dtype=content[4:7].decode()).
+    """
+    dtype = np.dtype(np.uint8) if result.max(initial=0) <= np.iinfo(np.uint8).max else np.dtype("<u2")
+    return b"KTSD" + dtype.str.encode() + struct.pack("<I", len(result)) + result.astype(dtype).tobytes()
+
+
+def encode_arrow(result):
+    """
+    Encodes the damage samples as an Arrow IPC stream with a single "damage" column.
+    """
+    buffer = io.BytesIO()
+    pl.DataFrame({"damage": result.astype(np.uint16)}).write_ipc_stream(buffer)
+    return buffer.getvalue()
+
+
 @app.get("/simulation")
-async def sim(op1: Json = Query(), op2: Json = Query(), cover: bool = False, obscured: bool = False, simnumber = 1000):
-    attacker = KTSim.Operator(op1)
-    defender = KTSim.Operator(op2)
-    sim = KTSim.Simulation(attacker, defender, cover, obscured)
-    print(sim.attacker)
-    print(sim.defender)
-    result = sim.run(int(simnumber))
-    print(result)
-    return {'result': result.tolist()}
+async def sim(
+    request: Request,
+    op1: Json = Query(),
+    op2: Json = Query(),
+    cover: bool = False,
+    obscured: bool = False,
+    simnumber = 1000,
+    mode: str = "sample",
+    seed: Optional[int] = None,
+    response: str = "samples",
+    cache: bool = True,
+    precision: Optional[float] = None,
+    target: str = "mean",
+):
+    if mode not in KTSim.MODES:
+        raise HTTPException(status_code=422, detail=f"Unknown mode {mode!r}, expected one of {KTSim.MODES}")
+    if response not in RESPONSES:
+        raise HTTPException(status_code=422, detail=f"Unknown response {response!r}, expected one of {RESPONSES}")
+    if target not in KTSim.TARGETS:
+        raise HTTPException(status_code=422, detail=f"Unknown target {target!r}, expected one of {KTSim.TARGETS}")
+    if precision is not None and precision <= 0:
+        raise HTTPException(status_code=422, detail=f"The precision must be positive, got {precision}")
+    with metrics.timer("operator_parsing"):
+        attacker = KTSim.Operator(op1)
+        defender = KTSim.Operator(op2)
+    sim = KTSim.Simulation(attacker, defender, cover, obscured, seed=seed)
 
-@app.get("/operators")
-async def get_operators():
-    with sqlite3.connect("killteam2024.db") as con:
-        df = pl.read_database(
-            query="""SELECT DISTINCT operators.id, killteams.killteamname, operators.opname, operators.M, operators.APL, operators.SV, operators.W FROM operators
-            JOIN killteams ON killteams.id = operators.killteam_id
-            """,
-            connection=con,
+    if mode == "exact":
+        # The seed and the number of samples do not change the exact result
+        key = matchup_key(sim, mode=mode, response=response)
+    elif precision is not None:
+        # The number of samples is chosen by the engine, until the target precision is reached
+        key = matchup_key(sim, mode=mode, precision=precision, target=target, seed=seed)
+    else:
+        # Unseeded requests are cached in memory only: the same matchup is answered with the same draw until
+        # cache=false or a restart, but a random draw is never replayed from disk
+        key = matchup_key(sim, mode=mode, response=response, simnumber=int(simnumber), seed=seed)
+    data = result_cache.get(key) if cache else None
+    metrics.increment("cache_misses" if data is None else "cache_hits")
+
+    result = None
+    if data is None:
+        if mode == "exact":
+            # pmf[i] is the probability to inflict exactly i damage
+            with metrics.timer("exact"):
+                pmf = sim.exact()
+            data = KTSim.summary(pmf, defender.wounds) if response == "summary" else {'pmf': pmf.tolist()}
+        elif precision is not None:
+            # A precision always answers with the summary, with the half-width reached and the samples it took
+            histogram, error = sim.run_until(precision, target)
+            data = KTSim.summary(histogram.pmf, defender.wounds) | {'error': error, 'samples': histogram.n}
+        elif response == "summary":
+            data = KTSim.summary(sim.stream(int(simnumber)).pmf, defender.wounds)
+        else:
+            result = sim.run(int(simnumber))
+            if int(simnumber) <= MAX_CACHED_SAMPLES:
+                data = {'result': result.tolist()}
+        if data is not None:
+            result_cache.set(key, data, persist=seed is not None or mode == "exact")
+    elif 'result' in data:
+        result = np.array(data['result'], dtype=KTSim.DAMAGE_DTYPE)
+
+    if result is not None:
+        # Clients asking for per-sample damage in a binary format skip the JSON encoding
+        accept = request.headers.get("accept", "")
+        if ARROW_MEDIA_TYPE in accept:
+            with metrics.timer("encoding"):
+                return Response(encode_arrow(result), media_type=ARROW_MEDIA_TYPE)
+        if BINARY_MEDIA_TYPE in accept:
+            with metrics.timer("encoding"):
+                return Response(encode_samples(result), media_type=BINARY_MEDIA_TYPE)
+    # The JSON response is rendered here rather than by FastAPI, so its encoding is timed like the binary ones
+    with metrics.timer("encoding"):
+        if data is None:
+            data = {'result': result.tolist()}
+        return JSONResponse(data)
+
+
+@app.post("/simulation/batch")
+async def sim_batch(
+    attackers: list = Body(),
+    defenders: list = Body(),
+    cover: bool = Body(False),
+    obscured: bool = Body(False),
+    simnumber: int = Body(1000),
+    mode: str = Body("sample"),
+    seed: Optional[int] = Body(None),
+    cache: bool = Body(True),
+):
+    # Every attacker weapon against every defender in one call, results[i][j] is the summary of attacker i against defender j
+    if not defenders:
+        raise HTTPException(status_code=422, detail="At least one defender is needed")
+    if mode not in KTSim.MODES:
+        raise HTTPException(status_code=422, detail=f"Unknown mode {mode!r}, expected one of {KTSim.MODES}")
+    with metrics.timer("operator_parsing"):
+        attackers = [KTSim.Operator(op) for op in attackers]
+        defenders = [KTSim.Operator(op) for op in defenders]
+
+    # The whole grid is cached, as its cells share their attack dice. As in /simulation, unseeded grids stay in memory
+    simulations = [[KTSim.Simulation(attacker, defender, cover, obscured) for defender in defenders] for attacker in attackers]
+    if mode == "exact":
+        key = batch_key(simulations, mode=mode)
+    else:
+        key = batch_key(simulations, mode=mode, simnumber=simnumber, seed=seed)
+    results = result_cache.get(key) if cache else None
+    metrics.increment("cache_misses" if results is None else "cache_hits")
+
+    if results is None:
+        grid = KTSim.matchup_matrix(attackers, defenders, cover, obscured, simnumber, mode, seed=seed)
+        results = [[KTSim.summary(pmf, defender.wounds) for pmf, defender in zip(row, defenders)] for row in grid]
+        result_cache.set(key, results, persist=seed is not None or mode == "exact")
+    with metrics.timer("encoding"):
+        return JSONResponse(
+            {
+                "attackers": [attacker.name for attacker in attackers],
+                "defenders": [defender.name for defender in defenders],
+                "results": results,
+            }
         )
 
-    return df.to_dicts()
+
+@app.get("/simulation/cache")
+async def sim_cache():
+    return result_cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, recorded only when the server runs with KTSIM_METRICS=1
+    return metrics.render()
+
+
+@app.get("/operators")
+async def get_operators():
+    return list(catalog_cache.get().operators_by_id.values())
 
 @app.get("/operators/KT/{killteamname}")
 async def get_ktoperators(killteamname: str):
-    with sqlite3.connect("killteam2024.db") as con:
-        df = pl.read_database(
-            query=f"""SELECT DISTINCT operators.id, killteams.killteamname, operators.opname, operators.M, operators.APL, operators.SV, operators.W FROM operators
-            JOIN killteams ON killteams.id = operators.killteam_id
-            WHERE killteams.killteamname = '{killteamname}'
-            """,
-            connection=con,
-        )
-
-    return df.to_dicts()
+    return catalog_cache.get().operators_by_killteam.get(killteamname, [])
 
 @app.get("/operators/profiles")
 def get_operators_profiles():
-    with sqlite3.connect("killteam2024.db") as con:
-
-        df = pl.read_database(
-            query="""SELECT DISTINCT operators.id, killteams.killteamname, operators.opname, operators.M, operators.APL, operators.SV, operators.W, 
-            GROUP_CONCAT(DISTINCT weapons.wepname), GROUP_CONCAT(DISTINCT keywords.keyword) FROM operators
-            JOIN killteams ON killteams.id = operators.killteam_id
-            JOIN operators_weapons_specialrules ON operators_weapons_specialrules.op_id = operators.id
-            JOIN weapons on operators_weapons_specialrules.wep_id = weapons.id
-            JOIN operators_keywords ON operators.id = operators_keywords.left_id
-            JOIN keywords ON keywords.id = operators_keywords.right_id
-            GROUP BY operators.id
-            """,
-            connection=con,
-        ).rename(
-            {"GROUP_CONCAT(DISTINCT weapons.wepname)": "weapons", "GROUP_CONCAT(DISTINCT keywords.keyword)": "keywords"}
-        )
+    df = read_database(
+        """SELECT op_id AS id, killteamname, opname, M, APL, SV, W, GROUP_CONCAT(DISTINCT wepname) AS weapons,
+        (SELECT GROUP_CONCAT(value) FROM json_each(keywords)) AS keywords FROM weapon_profiles
+        GROUP BY op_id
+        """
+    )
 
     return df.to_dicts()
 
 
 @app.get("/operators/{op_id}")
 def get_operator(op_id: int, wep_id: Optional[int] = None):
-    # res = cur.execute(f"SELECT * FROM operators where id = {op_id}")
-    if wep_id is None:
-        wep_id = "weapons.id"
-
-    with sqlite3.connect("killteam2024.db") as con:
-        df = pl.read_database(
-            query=f"""SELECT operators.opname, operators.M, operators.APL, operators.SV, operators.W, weapons.wepname, weapons.BS, weapons.D, weapons.DCrit, specialrules.keyword FROM operators
-            JOIN operators_weapons_specialrules ON operators_weapons_specialrules.op_id = {op_id}
-            JOIN weapons ON operators_weapons_specialrules.wep_id = weapons.id
-            JOIN specialrules ON operators_weapons_specialrules.sr_id = specialrules.id
-            WHERE operators.id = {op_id} and weapons.id = {wep_id}
-            """,
-            connection=con,
-        )
-
-        keywords = pl.read_database(
-            query=f"""SELECT keyword FROM keywords
-            JOIN operators_keywords ON operators_keywords.right_id = keywords.id
-            WHERE operators_keywords.left_id = {op_id}
-            """,
-            connection=con,
-        )
-
-    operator = df[0]["opname", "M", "APL", "SV", "W"].to_dicts()
-    operator[0]["weapons"] = [
-        {x[0][0]: {"BS": x[1]["BS"][0], "D": x[1]["D"][0], "DCrit": x[1]["DCrit"][0], "Keywords": x[1]["keyword"].to_list()}}
-        for x in df.group_by("wepname").sort("wepname")
-    ]
-    operator[0]["keywords"] = keywords.to_series().to_list()
-
-    # print(operator)
-    return operator
+    operator = catalog_cache.get().operator(op_id, wep_id)
+    if operator is None:
+        raise HTTPException(status_code=404, detail=f"Unknown operator {op_id}")
+    return [operator]
 
 
 @app.get("/operators/{op_id}/weapons/{wep_id}")
@@ -132,29 +264,8 @@ async def get_operator_wep(op_id: int, wep_id: int):
 
 @app.get("/killteams")
 async def get_killteams():
-    with sqlite3.connect("killteam2024.db") as con:
-        df = pl.read_database(
-            query="""SELECT killteamname FROM killteams
-            """,
-            connection=con,
-        )
-
-    return df.to_dicts()
+    return [{"killteamname": name} for name in catalog_cache.get().killteams_by_name]
 
 @app.get("/killteam/name/{kt_name}/operator/name/{op_name}")
 async def get_from_name_operator_wep(kt_name: str, op_name: str):
-    with sqlite3.connect("killteam2024.db") as con:
-        df = pl.read_database(
-            query=f"""SELECT DISTINCT operators.opname, operators.SV, operators.W, weapons.wepname, weapons.A, weapons.BS, weapons.D, weapons.DCrit, weapons.weptype, specialrules.keyword FROM operators
-            JOIN killteams ON killteams.id = operators.killteam_id
-            JOIN operators_weapons_specialrules ON operators_weapons_specialrules.op_id = operators.id
-            JOIN weapons ON operators_weapons_specialrules.wep_id = weapons.id
-            JOIN specialrules ON operators_weapons_specialrules.sr_id = specialrules.id
-            JOIN operators_keywords ON operators.id = operators_keywords.left_id
-            JOIN keywords ON keywords.id = operators_keywords.right_id
-            WHERE killteams.killteamname = '{kt_name}' and operators.opname = '{op_name}'
-            """,
-            connection=con,
-        )
-
-    return df.to_dicts()
\ No newline at end of file
+    return catalog_cache.get().profiles_by_name.get((kt_name, op_name), [])
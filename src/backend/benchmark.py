@@ -0,0 +1,221 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import KTSim
+import numpy as np
+
+SIZES = [10**3, 10**4, 10**5, 10**6]
+SUITE_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+# Representative weapon profiles of the suite: keywords, cover and obscured
+SUITE_PROFILES = {
+    "plain": ([], False, False),
+    "relentless": (["Relentless"], False, False),
+    "ceaseless": (["Ceaseless"], False, False),
+    "balanced": (["Balanced"], False, False),
+    "severe punishing rending": (["Severe", "Punishing", "Rending"], False, False),
+    "piercing": (["Prc 1"], False, False),
+    "piercing crit": (["PrcCrit 1", "Lethal 5+"], False, False),
+    "devastating": (["Dev 2", "Lethal 5+"], False, False),
+    "cover": ([], True, False),
+    "obscured": ([], False, True),
+}
+
+
+def time_call(function, *args, repeat=3, setup=None):
+    """
+    Returns the best wall time of `repeat` calls, in seconds.
+    `setup` returns fresh arguments before each call, outside the timed region, for functions that modify them.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        if setup is not None:
+            args = setup()
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_rerolls(sizes=SIZES, dice=4, threshold=3):
+    """
+    Times the reroll functions on the same rolls for each sample count.
+    The time per sample should stay flat as the sample count grows.
+    """
+    results = []
+    for n in sizes:
+        rolls = KTSim.generate_dice(n, dice)
+        for reroll in (KTSim.relentless, KTSim.balanced, KTSim.ceaseless):
+            # The rerolls modify the rolls in place, so every call gets its own copy of the original rolls
+            seconds = time_call(reroll, setup=lambda: (rolls.copy(), threshold, np.zeros_like(rolls, dtype=bool)))
+            results.append({"function": reroll.__name__, "n": n, "seconds": seconds, "ns_per_sample": seconds / n * 1e9})
+    return results
+
+
+def peak_memory(function, *args):
+    """
+    Returns the peak memory allocated by a call, in bytes.
+    """
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_memory(sizes=SIZES, dice=4, threshold=3):
+    """
+    Peak memory per sample of rolling the dice and applying the Ceaseless and Balanced rerolls,
+    with the engine's uint8 dice and with int64 dice.
+    """
+    results = []
+    for n in sizes:
+        for dtype in (KTSim.DICE_DTYPE, np.int64):
+
+            def roll_and_reroll():
+                rolls = np.random.default_rng().integers(1, 7, (n, dice), dtype=dtype)
+                reroll_mask = np.zeros_like(rolls, dtype=bool)
+                KTSim.ceaseless(rolls, threshold, reroll_mask)
+                KTSim.balanced(rolls, threshold, reroll_mask)
+
+            peak = peak_memory(roll_and_reroll)
+            results.append({"dtype": np.dtype(dtype).name, "n": n, "peak_bytes": peak, "bytes_per_sample": peak / n})
+    return results
+
+
+def profile(keywords, A=4, BS=3, D=3, DCrit=4, SV=3, W=10):
+    return KTSim.Operator({"opname": "", "wepname": "", "A": A, "BS": BS, "D": D, "DCrit": DCrit, "SV": SV, "W": W, "keyword": keywords})
+
+
+VARIANCE_PROFILES = {
+    "plain": [],
+    "lethal ceaseless": ["Lethal 5+", "Ceaseless"],
+    "piercing rending": ["Prc 1", "Rending"],
+}
+
+
+def bench_variance_reduction(n=20000, runs=30, cover=True):
+    """
+    RMS error of the damage pmf against the exact pmf, over `runs` independent runs of `n` samples,
+    for each sampler and variance reduction. The efficiency, 1 / (error**2 * CPU seconds), is relative
+    to the default counts sampler without variance reduction: 10 means the same error is reached 10 times faster.
+    """
+    results = []
+    for name, keywords in VARIANCE_PROFILES.items():
+        baseline = None
+        for sampler, variances in KTSim.VARIANCE_REDUCTIONS.items():
+            for variance in variances:
+                simulation = KTSim.Simulation(profile(keywords), profile([]), cover, sampler=sampler, variance=variance)
+                exact = simulation.exact()
+                squared_errors = []
+                start = time.process_time()
+                for seed in range(runs):
+                    pmf = simulation.stream(n, rng=np.random.default_rng(seed)).pmf
+                    size = max(len(pmf), len(exact))
+                    error = np.pad(pmf, (0, size - len(pmf))) - np.pad(exact, (0, size - len(exact)))
+                    squared_errors.append(np.sum(error**2))
+                seconds = (time.process_time() - start) / runs
+                rms = np.sqrt(np.mean(squared_errors))
+                efficiency = 1 / (rms**2 * seconds)
+                if baseline is None:
+                    baseline = efficiency
+                results.append(
+                    {
+                        "profile": name,
+                        "sampler": sampler,
+                        "variance": variance or "none",
+                        "rms_error": rms,
+                        "cpu_seconds": seconds,
+                        "relative_efficiency": efficiency / baseline,
+                    }
+                )
+    return results
+
+
+def bench_suite(profiles=SUITE_PROFILES, sizes=SUITE_SIZES, samplers=("counts",), repeat=3, seed=0):
+    """
+    Times Simulation.run for every profile, sampler and sample count, with its throughput and peak memory.
+    Each run draws from a generator seeded with `seed`, so the same dice are rolled from one commit to the next.
+    """
+    results = []
+    for name, (keywords, cover, obscured) in profiles.items():
+        for sampler in samplers:
+            simulation = KTSim.Simulation(profile(keywords), profile([]), cover, obscured, sampler=sampler)
+            # Builds the cached tables of the profile, so they are not timed with the first size
+            simulation.run(1)
+            for n in sizes:
+                # A fresh workspace for each call, so the buffers are part of the peak memory
+                seconds = time_call(lambda: simulation.run(n, np.random.default_rng(seed), KTSim.Workspace()), repeat=repeat)
+                peak = peak_memory(lambda: simulation.run(n, np.random.default_rng(seed), KTSim.Workspace()))
+                results.append(
+                    {
+                        "profile": name,
+                        "sampler": sampler,
+                        "n": n,
+                        "seconds": seconds,
+                        "samples_per_second": n / seconds,
+                        "peak_bytes": peak,
+                        "bytes_per_sample": peak / n,
+                    }
+                )
+    return results
+
+
+def environment():
+    """
+    Describes where the benchmark ran, so reports from different commits and machines can be told apart.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KTSim engine and report the results as JSON.")
+    parser.add_argument("--profiles", nargs="+", choices=list(SUITE_PROFILES), default=list(SUITE_PROFILES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=SUITE_SIZES)
+    parser.add_argument("--samplers", nargs="+", choices=list(KTSim.VARIANCE_REDUCTIONS), default=["counts"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON report to, instead of the standard output")
+    parser.add_argument(
+        "--micro", action="store_true", help="also run the reroll, memory and variance reduction benchmarks"
+    )
+    args = parser.parse_args(argv)
+
+    report = {
+        "environment": environment(),
+        "suite": bench_suite(
+            {name: SUITE_PROFILES[name] for name in args.profiles}, args.sizes, args.samplers, args.repeat, args.seed
+        ),
+    }
+    if args.micro:
+        report["rerolls"] = bench_rerolls()
+        report["memory"] = bench_memory()
+        report["variance_reduction"] = bench_variance_reduction()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import KTSim
+
+
+def matchup_key(simulation, **params):
+    """
+    Canonical key of a simulation request: the engine version, the attacker rules, the defender profile,
+    the scenario and the request parameters. Operator names are left out, so identical profiles share their results.
+    """
+    matchup = {
+        "version": KTSim.ENGINE_VERSION,
+        "attacker": simulation.rules.key(),
+        "defender": [simulation.defender.save, simulation.defender.wounds],
+        "cover": simulation.cover,
+        "obscured": simulation.obscured,
+        "sampler": simulation.sampler,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(matchup, sort_keys=True).encode()).hexdigest()
+
+
+def batch_key(simulations, **params):
+    """
+    Key of a grid of simulations computed together, made of the matchup key of every cell.
+    """
+    keys = [[matchup_key(simulation, **params) for simulation in row] for row in simulations]
+    return hashlib.sha256(json.dumps(keys).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    In-memory LRU of JSON results bounded by their encoded size, backed by a SQLite table so the results
+    survive restarts. A result larger than `max_entry_bytes` is not cached.
+    """
+
+    def __init__(self, path="simulation_cache.db", maxbytes=64 * 2**20, max_entry_bytes=2**20):
+        self.maxbytes = maxbytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.con.commit()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            row = self.con.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            value = json.loads(row[0])
+            self._remember(key, value, len(row[0]))
+            return value
+
+    def set(self, key, value, persist=True):
+        """
+        Caches a result. With persist=False it is only kept in memory, and is lost on restart.
+        """
+        encoded = json.dumps(value)
+        if len(encoded) > self.max_entry_bytes:
+            return
+        with self.lock:
+            self._remember(key, value, len(encoded))
+            if persist:
+                self.con.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, encoded))
+                self.con.commit()
+
+    def _remember(self, key, value, size):
+        if key in self.entries:
+            self.bytes -= self.sizes[key]
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.bytes += size
+        self.entries.move_to_end(key)
+        while self.bytes > self.maxbytes:
+            old, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.con.execute("DELETE FROM results")
+            self.con.commit()
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "bytes": self.bytes,
+            "maxbytes": self.maxbytes,
+        }
@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import threading
+
+import polars as pl
+
+OPERATORS_QUERY = """SELECT DISTINCT operators.id, killteams.killteamname, operators.opname, operators.M, operators.APL, operators.SV, operators.W FROM operators
+JOIN killteams ON killteams.id = operators.killteam_id
+"""
+
+# One row per operator weapon profile, built by database.write_WeaponProfilesTable
+WEAPON_PROFILES_QUERY = """SELECT killteamname, op_id, wep_id, opname, SV, W, wepname, A, BS, D, DCrit, weptype, rules FROM weapon_profiles
+"""
+
+OPERATOR_KEYWORDS_QUERY = """SELECT operators_keywords.left_id AS op_id, keywords.keyword FROM keywords
+JOIN operators_keywords ON operators_keywords.right_id = keywords.id
+"""
+
+
+class Catalog:
+    """
+    The catalog of the database loaded in memory, with dict indexes for the read endpoints.
+    A catalog is never modified once loaded.
+    """
+
+    def __init__(self, path="killteam2024.db"):
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as con:
+            killteams = pl.read_database("SELECT id, faction, killteamname FROM killteams", con)
+            operators = pl.read_database(OPERATORS_QUERY, con)
+            weapon_profiles = pl.read_database(WEAPON_PROFILES_QUERY, con)
+            operator_keywords = pl.read_database(OPERATOR_KEYWORDS_QUERY, con)
+
+        killteams_by_id = {row["id"]: row for row in killteams.to_dicts()}
+        killteams_by_name = {row["killteamname"]: row for row in killteams.to_dicts()}
+
+        operators_by_id = {}
+        operators_by_killteam = {name: [] for name in killteams_by_name}
+        for row in operators.to_dicts():
+            operators_by_id[row["id"]] = row
+            operators_by_killteam[row["killteamname"]].append(row)
+
+        profiles_by_name = {}
+        weapons_by_operator = {}
+        for row in weapon_profiles.to_dicts():
+            key = (row.pop("killteamname"), row["opname"])
+            op_id, wep_id = row.pop("op_id"), row.pop("wep_id")
+            # The row is also a profile KTSim.Operator can read
+            row["keyword"] = json.loads(row.pop("rules"))
+            profiles_by_name.setdefault(key, []).append(row)
+            weapons_by_operator.setdefault(op_id, {})[wep_id] = row
+
+        keywords_by_operator = {}
+        for row in operator_keywords.to_dicts():
+            keywords_by_operator.setdefault(row["op_id"], []).append(row["keyword"])
+
+        self.killteams = killteams
+        self.operators = operators
+        self.killteams_by_id = killteams_by_id
+        self.killteams_by_name = killteams_by_name
+        self.operators_by_id = operators_by_id
+        self.operators_by_killteam = operators_by_killteam
+        self.profiles_by_name = profiles_by_name
+        self.keywords_by_operator = keywords_by_operator
+        self.weapons_by_operator = weapons_by_operator
+
+    def operator(self, op_id, wep_id=None):
+        """
+        Profile of an operator with its weapons, sorted by name, and its keywords.
+        Returns None for an unknown operator.
+        """
+        if op_id not in self.operators_by_id:
+            return None
+        row = self.operators_by_id[op_id]
+        weapons = self.weapons_by_operator.get(op_id, {})
+        if wep_id is not None:
+            weapons = {wep_id: weapons[wep_id]} if wep_id in weapons else {}
+        operator = {key: row[key] for key in ("opname", "M", "APL", "SV", "W")}
+        operator["weapons"] = [
+            {weapon["wepname"]: {"BS": weapon["BS"], "D": weapon["D"], "DCrit": weapon["DCrit"], "Keywords": weapon["keyword"]}}
+            for weapon in sorted(weapons.values(), key=lambda weapon: weapon["wepname"])
+        ]
+        operator["keywords"] = self.keywords_by_operator.get(op_id, [])
+        return operator
+
+
+class CatalogCache:
+    """
+    Holds the catalog of a database file and loads it again when the file is modified.
+    """
+
+    def __init__(self, path="killteam2024.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = os.path.getmtime(path)
+        self.catalog = Catalog(path)
+
+    def get(self):
+        # The new catalog replaces the old one in a single assignment, so a request never sees half of a reload
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.catalog = Catalog(self.path)
+                    self.mtime = mtime
+        return self.catalog
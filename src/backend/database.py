@@ -1,7 +1,12 @@
+import argparse
+import hashlib
+import json
+import os
+import time
 from typing import List
 
 import requests
-from sqlalchemy import ForeignKey, create_engine, select
+from sqlalchemy import ForeignKey, create_engine, delete, insert, select, text, update
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -10,8 +15,9 @@ from sqlalchemy.orm import (
     sessionmaker,
 )
 
-req = requests.get("https://ktdash.app/api/faction.php?edition=kt24", timeout=5)
-faction_dict = {r["factionid"]: r["factionname"] for r in req.json()}
+KTDASH_URL = "https://ktdash.app/api"
+EXCLUDED_FACTIONS = ["Special Teams", "Homebrew"]
+EXCLUDED_FIRETEAMS = ["HBR", "NPO", "MALNPO"]
 
 
 class Base(DeclarativeBase):
@@ -54,6 +60,20 @@ class OperatorsKeywords(Base):
     keywords: Mapped["Keywords"] = relationship(back_populates="operators")
 
 
+class SyncState(Base):
+    """
+    Content hash of every kill team and operator as last synced, so an unchanged entity is not written again.
+    """
+
+    __tablename__ = "sync_state"
+    kind: Mapped[str] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+    hash: Mapped[str] = mapped_column()
+
+
+sync_state = SyncState.__table__
+
+
 class KillTeams(Base):
     __tablename__ = "killteams"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -89,14 +109,7 @@ class Weapons(Base):
     DCrit: Mapped[int] = mapped_column()
 
     operators: Mapped[List["OperatorsWeaponsSpecialRules"]] = relationship(back_populates="weapons")
-    specialrules: Mapped["OperatorsWeaponsSpecialRules"] = relationship(back_populates="weapons")
-
-    @classmethod
-    def get_or_create(session, self, **kwargs):
-        exists = session.query(Weapons.id).filter_by(**kwargs).scalar() is not None
-        if exists:
-            return session.query(Weapons).filter_by(**kwargs).first()
-        return self(**kwargs)
+    specialrules: Mapped["OperatorsWeaponsSpecialRules"] = relationship(back_populates="weapons", overlaps="operators")
 
 
 class Keywords(Base):
@@ -106,13 +119,6 @@ class Keywords(Base):
 
     operators: Mapped[List["OperatorsKeywords"]] = relationship(back_populates="keywords")
 
-    @classmethod
-    def get_or_create(session, self, **kwargs):
-        exists = session.query(Keywords.id).filter_by(**kwargs).scalar() is not None
-        if exists:
-            return session.query(Keywords).filter_by(**kwargs).first()
-        return self(**kwargs)
-
 
 class SpecialRules(Base):
     __tablename__ = "specialrules"
@@ -122,97 +128,371 @@ class SpecialRules(Base):
     weapons: Mapped["OperatorsWeaponsSpecialRules"] = relationship(back_populates="specialrules")
     # operators: Mapped[List["OperatorsWeaponsSpecialRules"]] = relationship(back_populates="specialrules")
 
-    @classmethod
-    def get_or_create(self,session, **kwargs):
-        exists = session.query(SpecialRules.id).filter_by(**kwargs).scalar() is not None
-        if exists:
-            return session.query(SpecialRules).filter_by(**kwargs).first()
-        return self(**kwargs)
 
-
-def write_KillTeamsTable(session):
-    req = requests.get("https://ktdash.app/api/killteam.php?edition=kt24")
-    for r in req.json():
-        if faction_dict[r["factionid"]] in ["Special Teams", "Homebrew"]:
+# The files of a snapshot directory are named after the API paths, so `python -m http.server -d <directory>` serves
+# the snapshot as a local stand-in for the API
+SNAPSHOT_FILES = {"factions": "faction.php", "killteams": "killteam.php"}
+
+
+def load_snapshot(source=KTDASH_URL):
+    """
+    Reads the factions and kill teams from `source`: the base URL of the API or of a local stand-in,
+    a snapshot directory, or a JSON file {"factions": [...], "killteams": [...]}.
+    """
+    if source.startswith(("http://", "https://")):
+        base = source.rstrip("/")
+        return {
+            name: requests.get(f"{base}/{filename}?edition=kt24", timeout=30).json()
+            for name, filename in SNAPSHOT_FILES.items()
+        }
+    if os.path.isdir(source):
+        snapshot = {}
+        for name, filename in SNAPSHOT_FILES.items():
+            with open(os.path.join(source, filename)) as file:
+                snapshot[name] = json.load(file)
+        return snapshot
+    with open(source) as file:
+        return json.load(file)
+
+
+def save_snapshot(snapshot, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, filename in SNAPSHOT_FILES.items():
+        with open(os.path.join(directory, filename), "w") as file:
+            json.dump(snapshot[name], file)
+
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def synced_killteams(snapshot):
+    """
+    Yields the kill teams of the snapshot that are ingested, with their faction name and their operators.
+    """
+    factions = {r["factionid"]: r["factionname"] for r in snapshot["factions"]}
+    for killteam in snapshot["killteams"]:
+        faction = factions[killteam["factionid"]]
+        if faction in EXCLUDED_FACTIONS:
             continue
-        newfaction = KillTeams(faction=faction_dict[r["factionid"]], killteamname=r["killteamname"])
-        session.add(newfaction)
+        operators = [
+            op
+            for fireteam in killteam["fireteams"]
+            if fireteam["factionid"] not in EXCLUDED_FIRETEAMS
+            for op in fireteam["operatives"]
+        ]
+        yield killteam, faction, operators
+
+
+def read_Operator(op):
+    """
+    Returns the row of an operator, its keywords and its weapon profiles as (key, row, special rules).
+    The weapon key holds the values as text, as SQLite compares "4" and 4 in an INTEGER column.
+    """
+    row = {
+        "opname": op["opname"],
+        "M": op["M"].replace('"', ""),
+        "APL": op["APL"],
+        "SV": op["SV"].replace("+", ""),
+        "W": op["W"],
+    }
+    keywords = [keyword.strip() for keyword in op["keywords"].split(",")]
+
+    weapons = []
+    for weapon in op["weapons"]:
+        for profile in weapon["profiles"]:
+            wepname = weapon["wepname"]
+            weptype = weapon["weptype"]
+            if profile["name"] != "":
+                wepname = wepname + " (" + profile["name"] + ")"
+            A = profile["A"]
+            BS = profile["BS"].replace("+", "")
+            try:
+                D, Dcrit = profile["D"].split("/")
+            except ValueError:
+                D = 0
+                Dcrit = 0
+            key = tuple(str(value) for value in (wepname, weptype, A, BS, D, Dcrit))
+            rules = [fix_string(sr.strip()) for sr in profile["SR"].split(",") if sr.strip() != ""]
+            weapon = {"wepname": wepname, "weptype": weptype, "A": A, "BS": BS, "D": D, "DCrit": Dcrit}
+            weapons.append((key, weapon, rules))
+    return row, keywords, weapons
+
+
+def get_id(ids, rows, key, **values):
+    """
+    Returns the id of `key`, adding a row with the next id the first time the key is seen.
+    """
+    if key not in ids:
+        ids[key] = len(ids) + 1
+        rows.append({"id": ids[key], **values})
+    return ids[key]
+
+
+def read_Catalog(snapshot):
+    """
+    Turns the snapshot of the API into the rows of every table, with their ids.
+    Keywords, weapons and special rules are deduplicated in dicts, so no query is needed to find an existing row.
+    """
+    tables = {
+        model: []
+        for model in (KillTeams, Operators, Keywords, Weapons, SpecialRules, OperatorsKeywords, OperatorsWeaponsSpecialRules)
+    }
+    killteam_ids, keyword_ids, weapon_ids, rule_ids = {}, {}, {}, {}
+    # Relations are kept in dicts, ordered and without the duplicates the primary keys would reject
+    operators_keywords, operators_weapons_specialrules = {}, {}
+
+    for killteam, faction, operators in synced_killteams(snapshot):
+        killteam_id = get_id(
+            killteam_ids, tables[KillTeams], killteam["killteamname"], faction=faction, killteamname=killteam["killteamname"]
+        )
+        for op in operators:
+            row, keywords, weapons = read_Operator(op)
+            op_id = len(tables[Operators]) + 1
+            tables[Operators].append({"id": op_id, "killteam_id": killteam_id, **row})
+
+            for keyword in keywords:
+                keyword_id = get_id(keyword_ids, tables[Keywords], keyword, keyword=keyword)
+                operators_keywords[op_id, keyword_id] = None
+            for key, weapon, rules in weapons:
+                wep_id = get_id(weapon_ids, tables[Weapons], key, **weapon)
+                for sr in rules:
+                    sr_id = get_id(rule_ids, tables[SpecialRules], sr, keyword=sr)
+                    operators_weapons_specialrules[op_id, wep_id, sr_id] = None
+
+    tables[OperatorsKeywords] = [{"left_id": left_id, "right_id": right_id} for left_id, right_id in operators_keywords]
+    tables[OperatorsWeaponsSpecialRules] = [
+        {"op_id": op_id, "wep_id": wep_id, "sr_id": sr_id} for op_id, wep_id, sr_id in operators_weapons_specialrules
+    ]
+    return tables
+
+
+def write_Catalog(session, snapshot):
+    """
+    Inserts the whole catalog and builds weapon_profiles in a single transaction, with one executemany per table.
+    Returns the number of rows written.
+    """
+    rows = 0
+    for model, values in read_Catalog(snapshot).items():
+        if values:
+            session.execute(insert(model), values)
+            rows += len(values)
+    hashes = [{"kind": kind, "key": key, "hash": hash} for kind, key, hash in snapshot_hashes(snapshot)]
+    session.execute(insert(sync_state), hashes)
+    write_WeaponProfilesTable(session)
     session.commit()
-
-
-def write_OperatorsWeaponsTable(session):
-    req = requests.get("https://ktdash.app/api/killteam.php?edition=kt24")
-
-    for killteam in req.json():
-        if faction_dict[killteam["factionid"]] in ["Special Teams", "Homebrew"]:
-            continue
-        for fireteam in killteam["fireteams"]:
-            factionid = fireteam["factionid"]
-            if factionid in ["HBR", "NPO", "MALNPO"]:
+    return rows
+
+
+def operator_key(killteamname, opname, occurrence):
+    # An operator is identified by its name in the kill team, and its rank among the operators of the same name
+    return f"{killteamname}/{opname}/{occurrence}"
+
+
+def snapshot_hashes(snapshot):
+    """
+    Yields the (kind, key, hash) of every kill team and operator of the snapshot.
+    """
+    for killteam, faction, operators in synced_killteams(snapshot):
+        yield "killteam", killteam["killteamname"], content_hash([faction, operators])
+        occurrences = {}
+        for op in operators:
+            occurrence = occurrences[op["opname"]] = occurrences.get(op["opname"], -1) + 1
+            yield "operator", operator_key(killteam["killteamname"], op["opname"], occurrence), content_hash(op)
+
+
+class Sync:
+    """
+    Applies a snapshot to an existing database in place: only the kill teams and operators whose content hash
+    changed are written, so the ids of the others are kept. Keywords, weapons and special rules are only inserted
+    when they are new.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.stats = {"killteams": 0, "operators": 0, "unchanged": 0, "removed": 0}
+        self.hashes = {(kind, key): hash for kind, key, hash in session.execute(select(sync_state))}
+        self.killteam_ids = {name: id for id, name in session.execute(select(KillTeams.id, KillTeams.killteamname))}
+        self.keyword_ids = {keyword: id for id, keyword in session.execute(select(Keywords.id, Keywords.keyword))}
+        self.rule_ids = {keyword: id for id, keyword in session.execute(select(SpecialRules.id, SpecialRules.keyword))}
+        self.weapon_ids = {}
+        weapons = select(Weapons.id, Weapons.wepname, Weapons.weptype, Weapons.A, Weapons.BS, Weapons.D, Weapons.DCrit)
+        for id, *values in session.execute(weapons.order_by(Weapons.id)):
+            self.weapon_ids.setdefault(tuple(str(value) for value in values), id)
+
+        self.operator_ids = {}
+        occurrences = {}
+        rows = session.execute(
+            select(Operators.id, Operators.opname, KillTeams.killteamname).join(KillTeams).order_by(Operators.id)
+        )
+        for id, opname, killteamname in rows:
+            occurrence = occurrences[killteamname, opname] = occurrences.get((killteamname, opname), -1) + 1
+            self.operator_ids[operator_key(killteamname, opname, occurrence)] = id
+
+    def new_id(self, ids, model, key, **values):
+        if key not in ids:
+            ids[key] = self.session.execute(insert(model).values(**values)).inserted_primary_key[0]
+        return ids[key]
+
+    def delete_hash(self, kind, key):
+        self.session.execute(delete(sync_state).where(sync_state.c.kind == kind, sync_state.c.key == key))
+
+    def set_hash(self, kind, key, hash):
+        self.delete_hash(kind, key)
+        self.session.execute(insert(sync_state).values(kind=kind, key=key, hash=hash))
+
+    def apply(self, snapshot):
+        """
+        Writes the changes of the snapshot and returns whether anything changed.
+        """
+        hashes = list(snapshot_hashes(snapshot))
+        seen = {(kind, key) for kind, key, _ in hashes}
+        changed = {(kind, key): hash for kind, key, hash in hashes if self.hashes.get((kind, key)) != hash}
+
+        for killteam, faction, operators in synced_killteams(snapshot):
+            name = killteam["killteamname"]
+            if ("killteam", name) not in changed and name in self.killteam_ids:
+                self.stats["unchanged"] += 1
                 continue
-            for op in fireteam["operatives"]:
-                opname = op["opname"]
-                m = op["M"].replace('"', "")
-                apl = op["APL"]
-                sv = op["SV"].replace("+", "")
-                w = op["W"]
-                ktid = session.execute(select(KillTeams).where(KillTeams.killteamname == killteam["killteamname"])).first()
-                newOperator = Operators(killteam_id=ktid[0].id, opname=opname, M=m, APL=apl, SV=sv, W=w)
-                session.add(newOperator)
-
-                keywords = op["keywords"].split(",")
-                for keyword in keywords:
-                    keyword = keyword.strip()
-                    newkeyword = Keywords.get_or_create(session, keyword=keyword)
-                    if newkeyword not in session:
-                        session.add(newkeyword)
-                    session.commit()
-                    Op_Keyword_rel = OperatorsKeywords(left_id=newOperator.id, right_id=newkeyword.id)
-                    session.add(Op_Keyword_rel)
-
-                for weapon in op["weapons"]:
-                    for profile in weapon["profiles"]:
-                        wepname = weapon["wepname"]
-                        weptype = weapon["weptype"]
-                        if profile["name"] != "":
-                            wepname = wepname + " (" + profile["name"] + ")"
-                        A = profile["A"]
-                        BS = profile["BS"].replace("+", "")
-                        try:
-                            D, Dcrit = profile["D"].split("/")
-                        except ValueError:
-                            D = 0
-                            Dcrit = 0
-                        SR = profile["SR"].split(",")
-                        newweapon = Weapons.get_or_create(session, wepname=wepname, weptype=weptype, A=A, BS=BS, D=D, DCrit=Dcrit)
-                        if newweapon not in session:
-                            session.add(newweapon)
-                        session.commit()
-                        # Op_Wep_rel = OperatorsWeapons(left_id=newOperator.id, right_id=newweapon.id)
-                        # session.add(Op_Wep_rel)
-                        # session.commit()
-                        for sr in SR:
-                            sr = sr.strip()
-                            if sr == "":
-                                continue
-                            sr = fix_string(sr)
-
-                            specialrules = SpecialRules.get_or_create(session, keyword=sr)
-                            if specialrules not in session:
-                                session.add(specialrules)
-                            session.commit()
-                            op_wep_sr_rel = OperatorsWeaponsSpecialRules(
-                                op_id=newOperator.id, wep_id=newweapon.id, sr_id=specialrules.id
-                            )
-                            exists = (
-                                session.query(OperatorsWeaponsSpecialRules.op_id)
-                                .filter_by(op_id=newOperator.id, wep_id=newweapon.id, sr_id=specialrules.id)
-                                .scalar()
-                                is not None
-                            )
-                            if not exists:
-                                session.add(op_wep_sr_rel)
-                        session.commit()
+            self.stats["killteams"] += 1
+            if name in self.killteam_ids:
+                killteam_id = self.killteam_ids[name]
+                self.session.execute(update(KillTeams).where(KillTeams.id == killteam_id).values(faction=faction))
+            else:
+                self.new_id(self.killteam_ids, KillTeams, name, faction=faction, killteamname=name)
+
+            occurrences = {}
+            for op in operators:
+                occurrence = occurrences[op["opname"]] = occurrences.get(op["opname"], -1) + 1
+                key = operator_key(name, op["opname"], occurrence)
+                if ("operator", key) in changed or key not in self.operator_ids:
+                    self.write_operator(key, self.killteam_ids[name], op)
+                    self.set_hash("operator", key, changed.get(("operator", key), content_hash(op)))
+            self.set_hash("killteam", name, changed.get(("killteam", name)))
+
+        # Operators and kill teams that left the snapshot
+        for key, op_id in list(self.operator_ids.items()):
+            if ("operator", key) not in seen:
+                self.delete_relations(op_id)
+                self.session.execute(delete(Operators).where(Operators.id == op_id))
+                self.delete_hash("operator", key)
+                self.stats["removed"] += 1
+        for name, killteam_id in list(self.killteam_ids.items()):
+            if ("killteam", name) not in seen:
+                self.session.execute(delete(KillTeams).where(KillTeams.id == killteam_id))
+                self.delete_hash("killteam", name)
+                self.stats["removed"] += 1
+
+        return self.stats["killteams"] > 0 or self.stats["removed"] > 0
+
+    def delete_relations(self, op_id):
+        self.session.execute(delete(OperatorsKeywords).where(OperatorsKeywords.left_id == op_id))
+        self.session.execute(
+            delete(OperatorsWeaponsSpecialRules).where(OperatorsWeaponsSpecialRules.op_id == op_id)
+        )
+
+    def write_operator(self, key, killteam_id, op):
+        """
+        Updates the operator in place, or inserts it, and replaces its keyword and weapon relations.
+        """
+        row, keywords, weapons = read_Operator(op)
+        if key in self.operator_ids:
+            op_id = self.operator_ids[key]
+            self.session.execute(update(Operators).where(Operators.id == op_id).values(killteam_id=killteam_id, **row))
+            self.delete_relations(op_id)
+        else:
+            result = self.session.execute(insert(Operators).values(killteam_id=killteam_id, **row))
+            op_id = self.operator_ids[key] = result.inserted_primary_key[0]
+        self.stats["operators"] += 1
+
+        operators_keywords = {}
+        for keyword in keywords:
+            operators_keywords[op_id, self.new_id(self.keyword_ids, Keywords, keyword, keyword=keyword)] = None
+        operators_weapons_specialrules = {}
+        for weapon_key, weapon, rules in weapons:
+            wep_id = self.new_id(self.weapon_ids, Weapons, weapon_key, **weapon)
+            for sr in rules:
+                sr_id = self.new_id(self.rule_ids, SpecialRules, sr, keyword=sr)
+                operators_weapons_specialrules[op_id, wep_id, sr_id] = None
+
+        if operators_keywords:
+            self.session.execute(
+                insert(OperatorsKeywords),
+                [{"left_id": left_id, "right_id": right_id} for left_id, right_id in operators_keywords],
+            )
+        if operators_weapons_specialrules:
+            self.session.execute(
+                insert(OperatorsWeaponsSpecialRules),
+                [
+                    {"op_id": op_id, "wep_id": wep_id, "sr_id": sr_id}
+                    for op_id, wep_id, sr_id in operators_weapons_specialrules
+                ],
+            )
+
+
+def sync_Catalog(session, snapshot):
+    """
+    Applies the snapshot to the database in a single transaction, and rebuilds weapon_profiles if anything changed.
+    Returns the counts of written, unchanged and removed entities.
+    """
+    sync = Sync(session)
+    if sync.apply(snapshot):
+        write_WeaponProfilesTable(session)
+    session.commit()
+    return sync.stats
+
+
+# One row per operator weapon profile, with the weapon rules and the operator keywords aggregated as JSON arrays.
+# The primary key is the name lookup of the API, so a WITHOUT ROWID table answers it with a single range read.
+WEAPON_PROFILES_SQL = [
+    "DROP TABLE IF EXISTS weapon_profiles",
+    """CREATE TABLE weapon_profiles (
+        killteamname VARCHAR NOT NULL,
+        opname VARCHAR NOT NULL,
+        op_id INTEGER NOT NULL,
+        wep_id INTEGER NOT NULL,
+        killteam_id INTEGER NOT NULL,
+        faction VARCHAR NOT NULL,
+        "M" INTEGER NOT NULL,
+        "APL" INTEGER NOT NULL,
+        "SV" INTEGER NOT NULL,
+        "W" INTEGER NOT NULL,
+        wepname VARCHAR NOT NULL,
+        weptype VARCHAR NOT NULL,
+        "A" INTEGER NOT NULL,
+        "BS" INTEGER NOT NULL,
+        "D" INTEGER NOT NULL,
+        "DCrit" INTEGER NOT NULL,
+        rules VARCHAR NOT NULL,
+        keywords VARCHAR NOT NULL,
+        PRIMARY KEY (killteamname, opname, op_id, wep_id)
+    ) WITHOUT ROWID""",
+    """INSERT INTO weapon_profiles
+    SELECT killteams.killteamname, operators.opname, operators.id, weapons.id, killteams.id, killteams.faction,
+        operators.M, operators.APL, operators.SV, operators.W,
+        weapons.wepname, weapons.weptype, weapons.A, weapons.BS, weapons.D, weapons.DCrit,
+        json_group_array(specialrules.keyword),
+        (
+            SELECT json_group_array(keywords.keyword) FROM operators_keywords
+            JOIN keywords ON keywords.id = operators_keywords.right_id
+            WHERE operators_keywords.left_id = operators.id
+        )
+    FROM operators
+    JOIN killteams ON killteams.id = operators.killteam_id
+    JOIN operators_weapons_specialrules ON operators_weapons_specialrules.op_id = operators.id
+    JOIN weapons ON weapons.id = operators_weapons_specialrules.wep_id
+    JOIN specialrules ON specialrules.id = operators_weapons_specialrules.sr_id
+    GROUP BY operators.id, weapons.id""",
+    "CREATE INDEX ix_weapon_profiles_op_id ON weapon_profiles (op_id, wep_id)",
+]
+
+
+def write_WeaponProfilesTable(session):
+    """
+    Rebuilds weapon_profiles in the transaction of the session, the caller commits it with the tables it is built from.
+    """
+    for statement in WEAPON_PROFILES_SQL:
+        session.execute(text(statement))
 
 
 def fix_string(sr):
@@ -249,18 +529,44 @@ def fix_string(sr):
         sr = sr.replace("Sil", "Silent")
     if "Acc1" in sr:
         sr = sr.replace("Acc1", "Acc 1")
-    if "Bal" in sr:
-        sr = sr.replace("Bal", "Balanced")
+    if sr == "Bal":
+        sr = "Balanced"
     return sr
 
 
 if __name__ == "__main__":
-    engine = create_engine("sqlite:///killteam2024.db", echo=False)
-    Base.metadata.drop_all(engine)
+    parser = argparse.ArgumentParser(description="Ingest the ktdash catalog in the kill team database.")
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=KTDASH_URL,
+        help="base URL of the API or of a local stand-in, snapshot directory, or snapshot JSON file",
+    )
+    parser.add_argument("--db", default="killteam2024.db")
+    parser.add_argument("--full", action="store_true", help="drop every table and ingest the snapshot from scratch")
+    parser.add_argument("--save", help="also write the snapshot to this directory, to sync offline later")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.source)
+    if args.save:
+        save_snapshot(snapshot, args.save)
+
+    engine = create_engine(f"sqlite:///{args.db}", echo=False)
+    if args.full:
+        Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
     Session = sessionmaker(bind=engine)
     mainsession = Session()
 
-    write_KillTeamsTable(mainsession)
-    write_OperatorsWeaponsTable(mainsession)
-    print("Writting done successfully.")
+    start = time.perf_counter()
+    if args.full:
+        rows = write_Catalog(mainsession, snapshot)
+        seconds = time.perf_counter() - start
+        print(f"Writting done successfully: {rows} rows in {seconds:.2f}s ({rows / seconds:.0f} rows/s).")
+    else:
+        stats = sync_Catalog(mainsession, snapshot)
+        seconds = time.perf_counter() - start
+        print(
+            f"Sync done in {seconds:.2f}s: {stats['killteams']} kill teams and {stats['operators']} operators written, "
+            f"{stats['unchanged']} kill teams unchanged, {stats['removed']} entities removed."
+        )
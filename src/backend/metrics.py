@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds of the timer histograms, in seconds
+BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+# Metrics are opt-in, set KTSIM_METRICS=1 or call enable() to record them
+enabled = os.environ.get("KTSIM_METRICS") == "1"
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations, in the Prometheus layout: one counter per bucket, their sum and count.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def observe(stage, seconds):
+    with _lock:
+        if stage not in _timers:
+            _timers[stage] = Histogram()
+        _timers[stage].observe(seconds)
+
+
+@contextmanager
+def _timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timer(stage):
+    """
+    Context manager recording the duration of a stage. When metrics are disabled it does nothing.
+    Stages timed in the worker processes of Simulation.stream are not recorded.
+    """
+    if not enabled:
+        return nullcontext()
+    return _timed(stage)
+
+
+def increment(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def render():
+    """
+    Returns the metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP ktsim_stage_seconds Duration of each stage of the simulation and of the requests.",
+        "# TYPE ktsim_stage_seconds histogram",
+    ]
+    with _lock:
+        for stage, histogram in sorted(_timers.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'ktsim_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'ktsim_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'ktsim_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'ktsim_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in sorted(_counters.items()):
+            lines.append(f"# TYPE ktsim_{name}_total counter")
+            lines.append(f"ktsim_{name}_total {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,44 @@
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Read-only SQLite connections opened once and shared by the requests.
+    Each connection keeps its prepared statements, so a query sent again is not parsed again.
+    """
+
+    def __init__(self, path="killteam2024.db", size=4, mmap_size=2**28, cached_statements=128):
+        self.path = path
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(self._connect())
+
+    def _connect(self):
+        # mode=ro fails instead of creating an empty database when the file is missing
+        con = sqlite3.connect(
+            f"file:{self.path}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        con.execute("PRAGMA query_only = ON")
+        con.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return con
+
+    @contextmanager
+    def connection(self):
+        # Blocks until a connection is free, so at most `size` queries run at once
+        con = self.connections.get()
+        try:
+            yield con
+        finally:
+            self.connections.put(con)
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
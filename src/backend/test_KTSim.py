@@ -0,0 +1,96 @@
+import pickle
+import unittest
+from functools import lru_cache
+
+import KTSim
+import numpy as np
+
+ATTACKER = {"opname": "Attacker", "wepname": "Bolt Rifle", "A": 4, "BS": 3, "D": 3, "DCrit": 4, "SV": 3, "W": 14, "keyword": ["Ceaseless", "Prc 1"]}
+DEFENDER = {"opname": "Defender", "wepname": "Fists", "A": 3, "BS": 4, "D": 2, "DCrit": 3, "SV": 4, "W": 8, "keyword": []}
+
+# Weapon keywords and scenario (cover, obscured) of the profiles checked against the exact engine
+PROFILES = {
+    "relentless": (["Relentless"], False, False),
+    "ceaseless balanced": (["Ceaseless", "Balanced"], False, False),
+    "severe punishing rending": (["Severe", "Punishing", "Rending", "Lethal 5+"], False, False),
+    "piercing crit": (["PrcCrit 1"], False, False),
+    "devastating": (["Dev 2", "Lethal 5+"], False, False),
+    "cover": (["Prc 1"], True, False),
+    "obscured": ([], False, True),
+}
+
+
+def operator(row, keywords=None):
+    if keywords is not None:
+        row = dict(row, keyword=keywords)
+    return KTSim.Operator(row)
+
+
+@lru_cache
+def least_damage(success, crit, def_success, def_crit, dmg, critdmg):
+    """Least damage the defender can take, trying every allocation of its saves one at a time."""
+    damages = [success * dmg + crit * critdmg]
+    if def_crit and crit:
+        damages.append(least_damage(success, crit - 1, def_success, def_crit - 1, dmg, critdmg))
+    if def_crit and success:
+        damages.append(least_damage(success - 1, crit, def_success, def_crit - 1, dmg, critdmg))
+    if def_success and success:
+        damages.append(least_damage(success - 1, crit, def_success - 1, def_crit, dmg, critdmg))
+    if def_success >= 2 and crit:
+        damages.append(least_damage(success, crit - 1, def_success - 2, def_crit, dmg, critdmg))
+    return min(damages)
+
+
+class TestExact(unittest.TestCase):
+    def test_samplers(self):
+        # The samples of both samplers must fall within a few standard errors of the exact distribution
+        n = 200000
+        for name, (keywords, cover, obscured) in PROFILES.items():
+            for sampler in ("counts", "dice"):
+                with self.subTest(profile=name, sampler=sampler):
+                    simulation = KTSim.Simulation(operator(ATTACKER, keywords), operator(DEFENDER), cover, obscured, sampler)
+                    exact = simulation.exact()
+                    self.assertAlmostEqual(exact.sum(), 1)
+                    pmf = KTSim.DamageHistogram().update(simulation.run(n, np.random.default_rng(0))).pmf
+                    size = max(len(pmf), len(exact))
+                    exact, pmf = np.pad(exact, (0, size - len(exact))), np.pad(pmf, (0, size - len(pmf)))
+                    tolerance = 5 * np.sqrt(exact * (1 - exact) / n) + 1e-4
+                    np.testing.assert_array_less(np.abs(pmf - exact), tolerance)
+
+
+class TestDamageTable(unittest.TestCase):
+    def test_least_damage(self):
+        for attacks, dmg, critdmg, devastating in [(4, 3, 4, 0), (5, 2, 5, 1), (6, 4, 3, 0), (3, 5, 6, 2)]:
+            table = KTSim.damage_table(attacks, dmg, critdmg, devastating)
+            for success in range(attacks + 1):
+                for crit in range(attacks + 1):
+                    for def_success in range(4):
+                        for def_crit in range(4):
+                            expected = least_damage(success, crit, def_success, def_crit, dmg, critdmg) + crit * devastating
+                            self.assertEqual(table[success, crit, def_success, def_crit], expected)
+
+
+class TestRules(unittest.TestCase):
+    def test_pickle(self):
+        rules = KTSim.compile_rules(4, 3, 3, 4, frozenset(["Lethal 5+", "Balanced"]))
+        copy = pickle.loads(pickle.dumps(rules))
+        self.assertEqual(copy, rules)
+        self.assertEqual(hash(copy), hash(rules))
+        with self.assertRaises(AttributeError):
+            copy.hit = 2
+
+
+class TestStream(unittest.TestCase):
+    def test_workers(self):
+        # The chunks draw from their own streams, so the processes must give the histogram of a single process
+        simulation = KTSim.Simulation(KTSim.Operator(ATTACKER), KTSim.Operator(DEFENDER), seed=1)
+        # A simulation that cannot be sent to the workers would hang the pool instead of failing
+        pickle.loads(pickle.dumps(simulation))
+        single = simulation.stream(200000, chunksize=50000, rng=np.random.default_rng(1))
+        shared = simulation.stream(200000, chunksize=50000, rng=np.random.default_rng(1), workers=2)
+        self.assertEqual(shared.n, 200000)
+        np.testing.assert_array_equal(shared.counts, single.counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,4 @@
 import datetime
-import json
 
 import numpy as np
 import pandas as pd
@@ -17,10 +16,9 @@ loading_gif = pn.pane.GIF('https://upload.wikimedia.org/wikipedia/commons/b/b1/L
 def update_weapon_list(attacker):
     kt_name = attacker['Kill Team']
     op_name = attacker['Operator']
-    weps_req = requests.get(f"http://127.0.0.1:8000/killteam/name/{kt_name}/operator/name/{op_name}", timeout=5).json()
-    result = {key: [d[key] for d in weps_req] for key in weps_req[0]}
-    weps = pd.DataFrame(result).groupby('wepname').agg({'A': 'first', 'BS': 'first', 'D': 'first', 'DCrit': 'first', 'weptype': 'first', 'keyword': lambda tdf: ', '.join(tdf.unique().tolist())}).reset_index()
-    weps = weps[weps['weptype'] == 'R']
+    # One row per weapon profile, with its keywords as a list
+    weps = pd.DataFrame(requests.get(f"http://127.0.0.1:8000/killteam/name/{kt_name}/operator/name/{op_name}", timeout=5).json())
+    weps = weps[weps['weptype'] == 'R'].assign(keyword=lambda df: df['keyword'].str.join(', '))
     weapondf.object = weps[['wepname', 'A', 'BS', 'D', 'DCrit', 'keyword']]
     weapon_selector.options = weps['wepname'].to_list()
     # return weps[['wepname', 'BS', 'D', 'DCrit', 'keyword']]
@@ -29,9 +27,7 @@ def update_weapon_list(attacker):
 def update_defender(defender):
     kt_name = defender['Kill Team']
     op_name = defender['Operator']
-    weps_req = requests.get(f"http://127.0.0.1:8000/killteam/name/{kt_name}/operator/name/{op_name}", timeout=5).json()
-    result = {key: [d[key] for d in weps_req] for key in weps_req[0]}
-    weps = pd.DataFrame(result)
+    weps = pd.DataFrame(requests.get(f"http://127.0.0.1:8000/killteam/name/{kt_name}/operator/name/{op_name}", timeout=5).json())
     weps = weps[weps['weptype'] == 'R']
     defender_info.object = weps[['opname', 'SV', 'W']].head(1)
     mpl_pane.object = None
@@ -47,42 +43,18 @@ def generate_simulation(attacker, weapons, defender, simnumber):
     wep_name = weapons
     defender_kt_name = defender['Kill Team']
     defender_op_name = defender['Operator']
+    # The rows are weapon profiles, they are sent to the simulation as they are
     attacker_req = requests.get(f"http://127.0.0.1:8000/killteam/name/{kt_name}/operator/name/{op_name}", timeout=5).json()
-    attacker_req = {key: [d[key] for d in attacker_req] for key in attacker_req[0]}
     defender_req = requests.get(f"http://127.0.0.1:8000/killteam/name/{defender_kt_name}/operator/name/{defender_op_name}", timeout=5).json()
-    defender_req = {key: [d[key] for d in defender_req] for key in defender_req[0]}
-    df_attacker = pd.DataFrame(attacker_req)
-    df_defender = pd.DataFrame(defender_req)
-    df_defender = df_defender.groupby('wepname').agg(
-        {
-            'opname': 'first', 
-            'SV': 'first', 
-            'W': 'first',
-            'A': 'first', 
-            'BS': 'first', 
-            'D': 'first', 
-            'DCrit': 'first', 
-            'keyword': lambda tdf: tdf.unique().tolist()}
-        ).reset_index()
-    defender_json = json.dumps(df_defender.iloc[0].to_dict())
-
-    for weapon in weapons:
-        attacker_line = df_attacker[df_attacker['wepname'] == weapon].groupby('wepname').agg(
-        {
-            'opname': 'first', 
-            'SV': 'first', 
-            'W': 'first', 
-            'A': 'first',
-            'BS': 'first', 
-            'D': 'first', 
-            'DCrit': 'first', 
-            'keyword': lambda tdf: tdf.unique().tolist()}
-        ).reset_index()
-        attacker_json = json.dumps(attacker_line.iloc[0].to_dict())
-        r = {'op1': attacker_json, 'op2': defender_json, 'cover':False, 'obscured':False, 'simnumber':simnumber}
-        simulation = requests.get('http://127.0.0.1:8000/simulation', params=r).json()
-        counts, bins = np.histogram(simulation['result'])
-        ax.stairs(counts/np.sum(counts) * 100, bins, label=weapon)
+    defender_json = defender_req[0]
+    attackers_json = [next(row for row in attacker_req if row['wepname'] == weapon and row['weptype'] == 'R') for weapon in weapons]
+
+    # All the selected weapons are simulated against the defender in a single request
+    r = {'attackers': attackers_json, 'defenders': [defender_json], 'cover': False, 'obscured': False, 'simnumber': simnumber}
+    simulation = requests.post('http://127.0.0.1:8000/simulation/batch', json=r).json()
+    for weapon, results in zip(weapons, simulation['results']):
+        pmf = np.array(results[0]['pmf'])
+        ax.stairs(pmf * 100, np.arange(len(pmf) + 1), label=weapon)
     
     ax.legend()
     mpl_pane.object = fig